@@ -8,13 +8,36 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 urllib3.disable_warnings()
 
 
 # set debug to 0 to enable
 debug = 0
 
+# first run window, and how far an incremental query reaches back before
+# the last run so registries changed while it ran are not missed
+ACR_TIME_RANGE = {"type": "relative", "value": {"unit": "hour", "amount": 24}}
+SYNC_OVERLAP_MS = 300000
+
+# larger registry specs are not PUT whole; new entries are POSTed instead
+REGISTRY_MAX_PAYLOAD = 4 * 1024 * 1024
+REGISTRY_SPEC_TEMPLATE = {
+    'version': 'azure',
+    'registry' : '',
+    'repository' : '',
+    'tag' : '',
+    'os' : 'linux',
+    'cap' : 5,
+    'credentialID': '',
+    'scanners': 2
+}
+
 def parse_args():
     """
     CLI argument handling
@@ -33,7 +56,14 @@ def parse_args():
     p.add_argument('-pcc','--pc-console',metavar='PC_CONSOLE', help='query the API of this Console')
     p.add_argument('-k','--api-key',metavar='API_KEY',help='API Key')
     p.add_argument('-rc','--registry-credential',metavar='REG_CRED',help='Registry Credential')
+    p.add_argument('-i','--incremental',action='store_true',help='query only registries changed since the last run and skip Compute entirely when none are new')
+    p.add_argument('--full',action='store_true',help='with --incremental, re-read every registry and reconcile the whole spec')
+    p.add_argument('--state',metavar='FILE',help='incremental state file (default ~/.prismacloud/acr_discovery.json)')
+    p.add_argument('--max-payload',dest='maxPayload',type=int,default=REGISTRY_MAX_PAYLOAD,help='largest registry spec PUT in bytes; past it each new registry is POSTed on its own (default %(default)s)')
+    p.add_argument('--workers',dest='workers',type=int,default=8,help='registries POSTed concurrently once the spec passes --max-payload')
+    p.add_argument('--rate',dest='rate',type=float,default=10.0,help='starting registry POSTs per second, adapts to 429/5xx responses')
     args = p.parse_args()
+    args.state = args.state or pclib.state_path('acr_discovery.json')
 
     # Populate args by env vars if they're set
     envvar_map = {
@@ -74,38 +104,24 @@ def printDebug(message):
 
 def getPCToken(console,user,password):
     printDebug("\nGetting PC bearer token.")
-    api = console + '/login'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pc_token(user,password,console)
     return(token)
 
 def getPCCToken(console,user,password):
     printDebug("\nGetting PCC bearer token.")
-    api = console + '/api/v1/authenticate'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pcc_token(user,password,console)
     return(token)
 
-def getACRLoginServers(console,token):
+def getACRLoginServers(console,token,timeRange=None):
     printDebug("\nGetting all ACR Registries")
-    headers = {
-        "accept": "text/csv; charset=UTF-8",
-        "content-type": "application/json; charset=UTF-8",
-        "x-redlock-auth": token
-    }
-    url = console + '/search/config'
-    payload = "{\"timeRange\":{\"value\":{\"unit\":\"hour\",\"amount\":24},\"type\":\"relative\"},\"withResourceJson\":true,\"query\":\"config from cloud.resource where api.name = 'azure-container-registry' addcolumn properties.loginServer \"}"
-    response = requests.request("POST", url, data=payload, headers=headers)
-    printDebug(response)
+    rql = "config from cloud.resource where api.name = 'azure-container-registry' addcolumn properties.loginServer "
     ACRList = []
-    for row in (response.text.splitlines())[2:]:
-        ACRInfoList = row.split(",")
-        printDebug("Found Azure Container Registry: " + ACRInfoList[-1])
-        ACRList.append(ACRInfoList[-1])
+    for row in pclib.iter_rql_rows(token,rql,console,['properties.loginServer'],time_range=timeRange or ACR_TIME_RANGE):
+        if row['properties.loginServer']:
+            printDebug("Found Azure Container Registry: " + row['properties.loginServer'])
+            ACRList.append(row['properties.loginServer'])
     printDebug("Found " + str(len(ACRList)) + " Azure Container Registries")
     return(ACRList)
 
@@ -114,8 +130,7 @@ def getPCCCreds(console,token):
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
     printDebug("\nGetting all PCC Credentials")
-    url = console + '/api/v1/credentials'
-    response = requests.get(url, headers=auth_headers, verify=False)
+    response = pclib.get_session(console, verify=False).get('/api/v1/credentials', headers=auth_headers)
     printDebug(response)
     credDictList = json.loads(response.text)
     for credRow in credDictList:
@@ -129,57 +144,163 @@ def getPCCRegistries(console,token):
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
     printDebug("\nGetting all PCC Registries")
-    url = console + '/api/v1/settings/registry'
-    response = requests.get(url, headers=auth_headers, verify=False)
+    response = pclib.get_session(console, verify=False).get('/api/v1/settings/registry', headers=auth_headers)
     printDebug(response)
     return (json.loads(response.text))
 
-def getAzureRegistryList(regDictList):
-    registries = []
-    printDebug("Found " + str(len(regDictList["specifications"])) + " total PCC registries")
-    for regRow in regDictList["specifications"]:
-        if (regRow["version"] == "azure"):
-            regRow["registry"] = regRow["registry"].lstrip("https://")
-            regRow["registry"] = regRow["registry"].split('/', 1)[0]
-            printDebug("Found PCC Azure Container registry: " + regRow["registry"])
-            registries.append(regRow["registry"])
-    printDebug("Found " + str(len(registries)) + " Azure PCC Registries already added")
-    return(registries)
-
-def getAzureRegistriesToAdd(pcRegisitries, pccRegistries):
-    return list(set(pcRegisitries) - set(pccRegistries))
-
-def updatePCCRulesJSON(PCCRegDict, regToAdd, regCred):
-    registryRuleTemplate = {
-        'version': 'azure',
-        'registry' : '',
-        'repository' : '',
-        'tag' : '',
-        'os' : 'linux',
-        'cap' : 5,
-        'credentialID': '',
-        'scanners': 2
-    }
-    workingRegistryDict = registryRuleTemplate 
-    workingRegistryDict["registry"] = regToAdd
-    workingRegistryDict["credentialID"] = regCred
-    PCCRegDict["specifications"].append(workingRegistryDict)
-    printDebug("Added " + regToAdd + " and " + regCred + " to registry specifications Dict")
-    return (PCCRegDict)
+def normalizeRegistry(registry):
+    # "https://Foo.azurecr.io/team/" -> "foo.azurecr.io"
+    registry = registry.strip().lower()
+    for scheme in ("https://", "http://"):
+        if registry.startswith(scheme):
+            registry = registry[len(scheme):]
+    return registry.split('/', 1)[0]
+
+def registrySpecKey(spec):
+    # repositories "" and "*" both mean every repository
+    repository = (spec.get("repository") or "").strip() or "*"
+    return (normalizeRegistry(spec.get("registry") or ""), repository, spec.get("credentialID") or "")
+
+def getRegistrySpecHash(specs):
+    # hash of the sorted spec keys, so the spec read from the console and
+    # the one this script wrote hash alike regardless of field order,
+    # defaults the console fills in or other settings in the response
+    keys = sorted(registrySpecKey(spec) for spec in specs)
+    return hashlib.sha256(json.dumps(keys).encode()).hexdigest()
+
+def reportDuplicateSpecs(specs):
+    # entries sharing a normalized (registry, repository, credential) key
+    printDebug("Found " + str(len(specs)) + " total PCC registries")
+    seen = set()
+    for spec in specs:
+        key = registrySpecKey(spec)
+        if key in seen:
+            printDebug("Duplicate registry specification: " + " ".join(key))
+        seen.add(key)
+
+def mergeRegistrySpecs(specs,loginServers,regCred):
+    # Returns (merged spec list, new entries).  Existing entries are left
+    # untouched; a login server is only added when no azure entry covers
+    # its registry yet, whatever its repository or credential.  Each new
+    # entry is a fresh copy of the template.
+    reportDuplicateSpecs(specs)
+    known = set(normalizeRegistry(spec.get("registry") or "") for spec in specs if spec.get("version") == "azure")
+    registries = sorted(set(normalizeRegistry(server) for server in loginServers if server))
+    newSpecs = [dict(REGISTRY_SPEC_TEMPLATE, registry=registry, credentialID=regCred)
+                for registry in registries if registry not in known]
+    printDebug("Found " + str(len(newSpecs)) + " Azure Registries to Add")
+    return (specs + newSpecs, newSpecs)
 
 def updateRegJSONRules(console,token,regDict):
     printDebug("\nUpdating all PCC Registries")
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
-    url = console + '/api/v1/settings/registry'
     regDictSpec = { "specifications" : regDict }
-    response = requests.put(url, headers=auth_headers, data=json.dumps(regDictSpec), verify=False)
+    response = pclib.get_session(console, verify=False).put('/api/v1/settings/registry', headers=auth_headers, data=json.dumps(regDictSpec))
     printDebug(response)
+    return 0 if response.ok else 1
+
+def addRegJSONRules(console,token,newSpecs,workers=8,limiter=None):
+    # POST /api/v1/settings/registry adds one entry to the spec on the
+    # console, so a spec too large to PUT whole still grows in small writes.
+    # The adds go through a bounded pool paced by an adaptive limiter.
+    printDebug("\nAdding " + str(len(newSpecs)) + " PCC Registries")
+    bearer = "Bearer " + token
+    auth_headers = {'content-type':'application/json', 'Authorization': bearer}
+    session = pclib.get_session(console, verify=False)
+    limiter = limiter or pclib.AdaptiveRateLimiter()
+    lock = threading.Lock()
+    counts = {"added": 0, "failed": 0}
+    def addSpec(spec):
+        response = session.request_retry('POST', '/api/v1/settings/registry', limiter=limiter, headers=auth_headers, data=json.dumps(spec))
+        with lock:
+            if response.ok:
+                counts["added"] += 1
+            else:
+                counts["failed"] += 1
+                print("Error adding " + spec["registry"] + ": " + str(response.status_code))
+            done = counts["added"] + counts["failed"]
+        if done % 100 == 0:
+            printDebug("Added " + str(done) + " of " + str(len(newSpecs)) + " registries")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(addSpec, spec) for spec in newSpecs]:
+            future.result()
+    return 0 if counts["failed"] == 0 else 1
+
+def writeRegistrySpecs(console,token,specs,newSpecs,maxPayload=REGISTRY_MAX_PAYLOAD,workers=8,limiter=None):
+    # one PUT of the merged spec, or concurrent adds once it passes maxPayload
+    if not newSpecs:
+        printDebug("Registry specifications already up to date, skipping update")
+        return 0
+    if len(json.dumps({"specifications": specs})) <= maxPayload:
+        return updateRegJSONRules(console,token,specs)
+    return addRegJSONRules(console,token,newSpecs,workers,limiter)
+
+def loadDiscoveryState(path,key):
+    return pclib.load_state(path).get(key, {})
+
+def saveDiscoveryState(path,key,state):
+    with pclib.file_lock(path):
+        allState = pclib.load_state(path)
+        allState[key] = state
+        pclib.save_state(path, allState)
+
+def incrementalSync(args,pcToken):
+    # State per PC console, Compute console and credential:
+    #   loginServers - every ACR login server seen so far
+    #   specHash - sha256 of the registry spec keys as this script last
+    #              left them (see getRegistrySpecHash)
+    #   syncedAt - epoch ms of the last run
+    # Only registries changed since syncedAt are queried.  When none of
+    # them is new, Compute is not contacted at all.  Otherwise the spec is
+    # read once: if its hash still matches, only the new login servers
+    # need checking, else every known one is reconciled against it.
+    stateKey = "|".join([args.pcConsole, args.pccConsole, args.regCred])
+    state = {} if args.full else loadDiscoveryState(args.state,stateKey)
+    now = int(time.time() * 1000)
+    timeRange = None
+    if state.get("syncedAt"):
+        timeRange = {"type": "absolute", "value": {"startTime": state["syncedAt"] - SYNC_OVERLAP_MS, "endTime": now}}
+    knownServers = set(state.get("loginServers", []))
+    changedServers = set(getACRLoginServers(args.pcConsole,pcToken,timeRange))
+    newServers = changedServers - knownServers
+    knownServers |= changedServers
+    printDebug("Found " + str(len(newServers)) + " new Azure Container Registries since the last run")
+    state["loginServers"] = sorted(knownServers)
+    state["syncedAt"] = now
+    if not newServers:
+        saveDiscoveryState(args.state,stateKey,state)
+        return 0
+    pccToken = getPCCToken(args.pccConsole,args.apiKey,args.apiSecret)
+    if args.regCred not in getPCCCreds(args.pccConsole,pccToken):
+        print(args.regCred + " not found in Prisma Cloud Compute credentials.")
+        return 1
+    PCCRegistries = getPCCRegistries(args.pccConsole,pccToken)
+    specHash = getRegistrySpecHash(PCCRegistries["specifications"])
+    candidates = newServers
+    if specHash != state.get("specHash"):
+        printDebug("Registry specifications changed since the last run, reconciling every known registry")
+        candidates = knownServers
+    specs, newSpecs = mergeRegistrySpecs(PCCRegistries["specifications"],candidates,args.regCred)
+    if writeRegistrySpecs(args.pccConsole,pccToken,specs,newSpecs,args.maxPayload,args.workers,pclib.AdaptiveRateLimiter(rate=args.rate)) != 0:
+        print("Error updating PCC registry specifications")
+        return 1
+    if newSpecs:
+        # the next run reads the spec back and compares it to this hash
+        specHash = getRegistrySpecHash(specs)
+    state["specHash"] = specHash
+    saveDiscoveryState(args.state,stateKey,state)
     return 0
 
 def main():
     args = parse_args()
+    pclib.get_session(args.pccConsole, verify=False, pool_size=max(args.workers, 10))
     pcToken = getPCToken(args.pcConsole,args.apiKey,args.apiSecret)
+    if args.incremental:
+        status = incrementalSync(args,pcToken)
+        if debug == 0:
+            pclib.print_session_stats()
+        return status
     pccToken = getPCCToken(args.pccConsole,args.apiKey,args.apiSecret)
     ACRLoginServers = getACRLoginServers(args.pcConsole,pcToken)
     PCCCreds = getPCCCreds(args.pccConsole,pccToken)
@@ -187,16 +308,12 @@ def main():
         print(args.regCred + " not found in Prisma Cloud Compute credentials.")
         sys.exit(1)
     PCCRegistries = getPCCRegistries(args.pccConsole,pccToken)
-    PCCAzureRegistries = getAzureRegistryList(PCCRegistries)
-    if (str(len(PCCAzureRegistries)) != 0):
-        PCCAzureRegistriesToAdd = getAzureRegistriesToAdd(ACRLoginServers,PCCAzureRegistries)
-    else:
-        PCCAzureRegistriesToAdd = ACRLoginServers
-    printDebug("Found " + str(len(PCCAzureRegistriesToAdd)) + " Azure Registries to Add")
     printDebug("\nUpdating PCC registry specifications Dict")
-    for reg in  PCCAzureRegistriesToAdd:
-        PCCRegistries = updatePCCRulesJSON(PCCRegistries,reg,args.regCred)
-    updateStatus = updateRegJSONRules(args.pccConsole,pccToken,PCCRegistries["specifications"])
+    specs, newSpecs = mergeRegistrySpecs(PCCRegistries["specifications"],ACRLoginServers,args.regCred)
+    updateStatus = writeRegistrySpecs(args.pccConsole,pccToken,specs,newSpecs,args.maxPayload,args.workers,pclib.AdaptiveRateLimiter(rate=args.rate))
+    if debug == 0:
+        pclib.print_session_stats()
+    return updateStatus
 
 
 if __name__ == '__main__':
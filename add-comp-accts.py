@@ -8,7 +8,11 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 urllib3.disable_warnings()
 
 debug = 0
@@ -19,9 +23,17 @@ def parse_args():
     parser.add_argument('--pcc_console', dest='pccConsole', type=str, help='Prisma Cloud Compute API URL', required=True)
     parser.add_argument('--api_key', dest='apiKey', type=str, help='API Key', required=True)
     parser.add_argument('--api_secret', dest='apiSecret', type=str, help='API Secret')
+    parser.add_argument('--dry_run', dest='dryRun', action='store_true', help='List the credentials that would be created without creating them')
+    parser.add_argument('--workers', dest='workers', type=int, default=16, help='Credentials created concurrently')
+    parser.add_argument('--rate', dest='rate', type=float, default=20.0, help='Starting requests per second; backs off on 429/5xx')
+    parser.add_argument('--batch_size', dest='batchSize', type=int, default=100, help='Credentials per batch; progress and the checkpoint are written after each batch')
+    parser.add_argument('--accounts_ttl', dest='accountsTTL', type=int, default=pclib.CLOUD_ACCOUNTS_TTL, help='Seconds the cached Prisma Cloud account list is reused before the account hierarchy is crawled again')
+    parser.add_argument('--refresh_accounts', dest='refreshAccounts', action='store_true', help='Crawl the account hierarchy even when the cache is fresh')
+    parser.add_argument('--checkpoint', dest='checkpoint', type=str, help='Resume checkpoint file (default ~/.prismacloud/add_comp_accts.json)')
     args = parser.parse_args()
     if getattr(args,'apiSecret',None) is None:
-        args.api_secret = getpass.getpass('Enter password: ')
+        args.apiSecret = getpass.getpass('Enter password: ')
+    args.checkpoint = args.checkpoint or pclib.state_path('add_comp_accts.json')
     return args
 
 def printDebug(message):
@@ -31,85 +43,128 @@ def printDebug(message):
 
 def getPCToken(console,user,password):
     printDebug("\nGetting PC bearer token.")
-    api = console + '/login'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pc_token(user,password,console)
     return(token)
 
 def getPCCToken(console,user,password):
     printDebug("\nGetting PCC bearer token.")
-    api = console + '/api/v1/authenticate'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pcc_token(user,password,console)
     return(token)
 
-def getPCAzureAccounts(console,token):
-    azureAccounts = dict()
-    printDebug("\nGetting all PC Azure Accounts in Root Tenant")
-    headers = {
-        'content-type':'application/json',
-        'x-redlock-auth': token
-    }
-    parent_id = "eb06985d-06ca-4a17-81da-629ab99f6505"
-    url = console + "/cloud/azure/"+parent_id+"/project"
-    query = {
-       'excludeAccountGropupDetails':'true'
-    }
-    response = requests.get(url, headers=headers, params=query, verify=False)
-    printDebug(response)
-    for account in json.loads(response.text):
-        #printDebug(account['accountId'] +" = "+account['name'])
-        azureAccounts[account['accountId']] = account['name'] 
+def getPCAzureAccounts(console,user,token,ttl=pclib.CLOUD_ACCOUNTS_TTL,refresh=False):
+    # every subscription under every onboarded Azure tenant, from the
+    # account cache of this console and access key unless it is older
+    # than ttl seconds
+    printDebug("\nGetting all PC Azure Accounts")
+    azureAccounts = pclib.cached_cloud_accounts(token,console,user,ttl=ttl,refresh=refresh)["azure"]
+    printDebug("Found " + str(len(azureAccounts)) + " Azure Accounts")
     return azureAccounts
 
 def getPCCCredentials(console,token):
-    azureCreds = []
+    azureCreds = set()
     printDebug("\nGetting all PCC Mapped PC Azure Creds")
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
-    url = console + '/api/v1/credentials'
-    response = requests.get(url, headers=auth_headers, verify=False)
+    response = pclib.get_session(console, verify=False).get('/api/v1/credentials', headers=auth_headers)
     printDebug(response)
     credDictList = json.loads(response.text)
     for credRow in credDictList:
         if (credRow["type"] == "azure"):
-            azureCreds.append(credRow["_id"])
+            azureCreds.add(credRow["_id"])
     printDebug("Found " + str(len(azureCreds)) + " Azure Credentials")
     return azureCreds
 
-def getPccAddAccounts(pcAccounts,pccAccounts):
-    acctsToAdd = {key:val for key, val in pcAccounts.items() if val not in pccAccounts}
+def getPccAddAccounts(pcAccounts,pccAccounts,done=()):
+    # pccAccounts and done are sets, so the diff is linear in the accounts
+    acctsToAdd = {key:val for key, val in pcAccounts.items() if val not in pccAccounts and key not in done}
     # returns all accounts to be added in a dict with key = id and value = name
     return acctsToAdd
 
-def setUpPCCAccounts(console,token,addAccountsToPCC):
+def loadCheckpoint(path,console):
+    return set(pclib.load_state(path).get(console, []))
+
+def saveCheckpoint(path,console,done):
+    # done=None drops the console's checkpoint once a run completes
+    with pclib.file_lock(path):
+        state = pclib.load_state(path)
+        if done is None:
+            state.pop(console, None)
+        else:
+            state[console] = sorted(done | set(state.get(console, [])))
+        pclib.save_state(path, state)
+
+def setUpPCCAccount(session,auth_headers,limiter,acct,name):
+    data = {
+        '_id': name,
+        'accountID': acct,
+        'type': 'azure'
+    }
+    try:
+        response = session.request_retry('POST', '/api/v1/credentials', limiter=limiter, json=data, headers=auth_headers)
+    except OSError as e:
+        return type(e).__name__
+    # 409: created by an earlier, interrupted run
+    return 200 if response.status_code in (200, 201, 409) else response.status_code
+
+def setUpPCCAccounts(console,token,addAccountsToPCC,args):
+    # Creates the credentials concurrently in batches of args.batchSize.
+    # After every batch the accounts created so far are added to the
+    # checkpoint, so an interrupted run resumes where it stopped.
+    # Returns the number of failed accounts
     printDebug("\nSetting up PCC Accounts")
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
-    api = console + '/api/v1/credentials'
-    for acct in addAccountsToPCC:
-        printDebug("Setting up account "+addAccountsToPCC[acct])
-        data = {
-            '_id': addAccountsToPCC[acct],
-            'accountID': acct,
-            'type': 'azure'
-        }
-        #response = requests.post(api, json=data, headers=auth_headers, verify=False)
-        #printDebug(response)
-    
+    session = pclib.get_session(console, verify=False)
+    limiter = pclib.AdaptiveRateLimiter(rate=args.rate)
+    accounts = sorted(addAccountsToPCC.items())
+    batches = (len(accounts) + args.batchSize - 1) // args.batchSize
+    start = time.time()
+    failedTotal = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for batch in range(batches):
+            batchStart = time.time()
+            chunk = accounts[batch * args.batchSize:(batch + 1) * args.batchSize]
+            futures = {acct: pool.submit(setUpPCCAccount,session,auth_headers,limiter,acct,name) for acct, name in chunk}
+            done = set()
+            failed = {}
+            for acct, future in futures.items():
+                status = future.result()
+                if status == 200:
+                    done.add(acct)
+                else:
+                    failed[acct] = status
+                    printDebug("Failed to set up account " + addAccountsToPCC[acct] + ": " + str(status))
+            saveCheckpoint(args.checkpoint,console,done)
+            failedTotal += len(failed)
+            elapsed = time.time() - batchStart
+            print("Batch {}/{}: {} created, {} failed in {:.1f}s ({:.1f}/s), rate {:.1f}/s, {} of {} done in {:.0f}s".format(
+                batch + 1, batches, len(done), len(failed), elapsed, len(chunk) / elapsed if elapsed else 0,
+                limiter.rate, min((batch + 1) * args.batchSize, len(accounts)), len(accounts), time.time() - start))
+    return failedTotal
 
 def main():
     args = parse_args()
     pcToken = getPCToken(args.pcConsole,args.apiKey,args.apiSecret)
+    pclib.get_session(args.pccConsole, verify=False, pool_size=args.workers)
     pccToken = getPCCToken(args.pccConsole,args.apiKey,args.apiSecret)
-    pcAzureAccounts = getPCAzureAccounts(args.pcConsole,pcToken)
+    pcAzureAccounts = getPCAzureAccounts(args.pcConsole,args.apiKey,pcToken,args.accountsTTL,args.refreshAccounts)
     pccAzureCredentials = getPCCCredentials(args.pccConsole,pccToken)
-    addAccountsToPCC = getPccAddAccounts(pcAzureAccounts,pccAzureCredentials)
-    setUpPCCAccounts(args.pccConsole,pccToken,addAccountsToPCC)
+    done = loadCheckpoint(args.checkpoint,args.pccConsole)
+    addAccountsToPCC = getPccAddAccounts(pcAzureAccounts,pccAzureCredentials,done)
+    print("{} Azure accounts, {} with credentials, {} in the checkpoint, {} to set up".format(
+        len(pcAzureAccounts), len(pccAzureCredentials), len(done), len(addAccountsToPCC)))
+    if args.dryRun:
+        for acct, name in sorted(addAccountsToPCC.items()):
+            print("Would set up account " + name + " (" + acct + ")")
+        return 0
+    failed = setUpPCCAccounts(args.pccConsole,pccToken,addAccountsToPCC,args)
+    if not failed:
+        saveCheckpoint(args.checkpoint,args.pccConsole,None)
+    if debug == 0:
+        pclib.print_session_stats()
+    return 1 if failed else 0
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -8,7 +8,11 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 urllib3.disable_warnings()
 
 debug = 0
@@ -18,6 +22,9 @@ def parse_args():
     parser.add_argument('--pcc_console', dest='pccConsole', type=str, help='Prisma Cloud Compute API URL', required=True)
     parser.add_argument('--api_key', dest='apiKey', type=str, help='API Key', required=True)
     parser.add_argument('--api_secret', dest='apiSecret', type=str, help='API Secret')
+    parser.add_argument('--workers', dest='workers', type=int, default=16, help='Incidents archived concurrently')
+    parser.add_argument('--page_size', dest='pageSize', type=int, default=50, help='Incidents fetched per page')
+    parser.add_argument('--rate', dest='rate', type=float, default=20.0, help='Starting archive requests per second, adapts to 429/5xx responses')
     args = parser.parse_args()
     if getattr(args,'apiSecret',None) is None:
         args.api_secret = getpass.getpass('Enter password: ')
@@ -30,44 +37,109 @@ def printDebug(message):
 
 def getPCCToken(console,user,password):
     printDebug("\nGetting PCC bearer token.")
-    api = console + '/api/v1/authenticate'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pcc_token(user,password,console)
     return(token)
 
-def getActiveIncidents(console,token):
-    allIncidents=[]
-    printDebug("\nGetting all PCC Active Compute Incidents")
+def getActiveIncidents(console,token,seen,pending,failed,limit=50):
+    # One walk over the unacknowledged incidents, yielding IDs not handed
+    # out yet.  pending holds the IDs handed out and not yet acknowledged
+    # (in flight or failed); acknowledged ones drop out of the list, so
+    # each page starts at len(pending) rather than at a running offset.
+    # That can overshoot when archives land between counting and the
+    # GET, so once a page brings nothing new (or the list ends) the walk
+    # waits for the archives in flight and then pages from the front,
+    # past the failed IDs, with an exact offset.  It stops when that
+    # settled pass reaches the end without anything new.
+    printDebug("\nPaging PCC Active Compute Incidents")
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
-    url = console + '/api/v1/audits/incidents?acknowledged=false'
-    response = requests.get(url, headers=auth_headers, verify=False) 
-    printDebug(response)
-    for incident in json.loads(response.text):
-        allIncidents.append(incident["_id"])
-    return allIncidents
+    session = pclib.get_session(console, verify=False)
+    settled = False
+    offset = 0
+    while True:
+        query = {'acknowledged': 'false', 'limit': limit, 'offset': offset if settled else len(pending)}
+        response = session.request_retry('GET', '/api/v1/audits/incidents', headers=auth_headers, params=query)
+        response.raise_for_status()
+        page = json.loads(response.text) or []
+        new = [incident["_id"] for incident in page if incident["_id"] not in seen]
+        for incident in new:
+            seen.add(incident)
+            pending.add(incident)
+            yield incident
+        if settled and not new:
+            if len(page) < limit:
+                return
+            # a page of failed IDs; nothing is in flight, so offsets hold
+            offset += limit
+            continue
+        if new and len(page) == limit:
+            settled = False
+            continue
+        while len(pending) > len(failed):
+            time.sleep(0.05)
+        settled = True
+        offset = 0
 
-def archiveIncidents(console,token,incidents):
-    printDebug("\nArchiving incidents: ")
+def archiveIncident(session,auth_headers,limiter,incident):
+    api = '/api/v1/audits/incidents/acknowledge/' + incident
+    try:
+        response = session.request_retry('PATCH', api, limiter=limiter, headers=auth_headers, data="{\"acknowledged\":true}")
+    except OSError as e:
+        return type(e).__name__
+    return response.status_code
+
+def archiveIncidents(console,token,incidents,workers=16,limiter=None,pending=None,failedIDs=None):
+    # incidents may be a generator; IDs are archived while later pages
+    # are still being fetched, with at most workers * 4 queued at once.
+    # Archived IDs are removed from pending, failed ones added to failedIDs
+    printDebug("\nArchiving incidents")
     bearer = "Bearer " + token
     auth_headers = {'content-type':'application/json', 'Authorization': bearer}
-    for incident in incidents:
-        api = console + '/api/v1/audits/incidents/acknowledge/' + incident
-        response = requests.patch(api, headers=auth_headers, data="{\"acknowledged\":true}", verify=False)
-        if response.status_code == 200:
-            printDebug("\t" + incident + " Successfully archived")
-        else:
-            printDebug("\t" + incident + " Failed archiving")
+    session = pclib.get_session(console, verify=False)
+    limiter = limiter or pclib.AdaptiveRateLimiter()
+    start = time.time()
+    results = {}
+    queued = threading.BoundedSemaphore(workers * 4)
+    lock = threading.Lock()
+    pending = set() if pending is None else pending
+    failedIDs = set() if failedIDs is None else failedIDs
+    def done(incident,future):
+        status = future.result()
+        with lock:
+            results[status] = results.get(status, 0) + 1
+            if status == 200:
+                pending.discard(incident)
+            else:
+                failedIDs.add(incident)
+        queued.release()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for incident in incidents:
+            queued.acquire()
+            future = pool.submit(archiveIncident,session,auth_headers,limiter,incident)
+            future.add_done_callback(lambda future, incident=incident: done(incident,future))
+    elapsed = time.time() - start
+    archived = results.pop(200, 0)
+    failed = sum(results.values())
+    print("Archived {} incidents in {:.1f}s ({:.1f}/s), {} failed, final rate {:.1f}/s".format(
+        archived, elapsed, archived / elapsed if elapsed else 0, failed, limiter.rate))
+    for status, count in sorted(results.items(), key=str):
+        print("\t{} failed with {}".format(count, status))
+    return archived, failed
 
 def main():
     args = parse_args()
+    pclib.get_session(args.pccConsole, verify=False, pool_size=args.workers)
     pccToken = getPCCToken(args.pccConsole,args.apiKey,args.apiSecret)
-    allActiveIncidents = getActiveIncidents(args.pccConsole,pccToken)
-    while allActiveIncidents:
-        archiveIncidents(args.pccConsole,pccToken,allActiveIncidents)
-        allActiveIncidents = getActiveIncidents(args.pccConsole,pccToken)
+    limiter = pclib.AdaptiveRateLimiter(rate=args.rate)
+    seen = set()
+    pending = set()
+    failedIDs = set()
+    incidents = getActiveIncidents(args.pccConsole,pccToken,seen,pending,failedIDs,args.pageSize)
+    archived, failed = archiveIncidents(args.pccConsole,pccToken,incidents,args.workers,limiter,pending,failedIDs)
+    if debug == 0:
+        pclib.print_session_stats()
+    return 1 if failed else 0
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Benchmark cfgdiff.diff against deepdiff.DeepDiff on Azure SQL database
+# shaped documents: nested properties, tags, keyed firewall/audit rule
+# lists and volatile etag/timestamp fields, with a handful of real changes.
+# DeepDiff is configured to match cfgdiff's defaults: list order ignored
+# and the same etag/timestamp fields excluded.
+
+import argparse
+import copy
+import random
+import sys
+import time
+import cfgdiff
+
+
+# cfgdiff.IGNORE_PATHS as DeepDiff path regexes
+DEEPDIFF_EXCLUDE = [
+    r"\['etag'\]$",
+    r"\['lastModified[^']*'\]$",
+    r"\['modifiedTime'\]$",
+    r"\['[^']*Timestamp'\]$",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark cfgdiff against DeepDiff')
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000], help='firewall rules per document')
+    parser.add_argument('--iterations', type=int, default=20, help='diffs timed per size')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    return parser.parse_args()
+
+
+def make_database(rules, rng):
+    ts = '2026-10-01T00:00:00Z'
+    return {
+        'id': '/subscriptions/0000/resourceGroups/rg/providers/Microsoft.Sql/servers/srv/databases/db',
+        'name': 'db',
+        'etag': 'W/"%d"' % rng.randint(0, 1 << 30),
+        'location': 'eastus',
+        'tags': dict(('tag%d' % i, 'value%d' % i) for i in range(20)),
+        'sku': {'name': 'GP_Gen5', 'tier': 'GeneralPurpose', 'capacity': 2},
+        'properties': {
+            'status': 'Online',
+            'collation': 'SQL_Latin1_General_CP1_CI_AS',
+            'maxSizeBytes': 34359738368,
+            'creationDate': ts,
+            'lastModifiedTime': ts,
+            'zoneRedundant': False,
+            'readScale': 'Disabled',
+            'firewallRules': [
+                {
+                    'id': 'rule-%d' % i,
+                    'name': 'rule%d' % i,
+                    'etag': 'W/"%d"' % i,
+                    'properties': {'startIpAddress': '10.0.%d.0' % (i % 256), 'endIpAddress': '10.0.%d.255' % (i % 256)}
+                } for i in range(rules)
+            ],
+            'auditingSettings': {
+                'state': 'Enabled',
+                'retentionDays': 90,
+                'auditActionsAndGroups': ['SUCCESSFUL_DATABASE_AUTHENTICATION_GROUP', 'FAILED_DATABASE_AUTHENTICATION_GROUP', 'BATCH_COMPLETED_GROUP']
+            },
+            'transparentDataEncryption': {'status': 'Enabled'}
+        }
+    }
+
+
+def mutate(database, rng):
+    changed = copy.deepcopy(database)
+    changed['etag'] = 'W/"%d"' % rng.randint(0, 1 << 30)
+    changed['properties']['lastModifiedTime'] = '2026-10-02T00:00:00Z'
+    changed['properties']['status'] = 'Paused'
+    changed['tags']['owner'] = 'dba'
+    rules = changed['properties']['firewallRules']
+    rules[rng.randrange(len(rules))]['properties']['endIpAddress'] = '10.255.255.255'
+    rules.insert(0, rules.pop())
+    return changed
+
+
+def timed(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = fn()
+    return (time.perf_counter() - start) / iterations, result
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    try:
+        from deepdiff import DeepDiff
+    except ImportError:
+        DeepDiff = None
+        print('deepdiff is not installed, timing cfgdiff only', file=sys.stderr)
+    print('{:>8} {:>14} {:>8} {:>14} {:>8} {:>9}'.format('Rules', 'cfgdiff ms', 'changes', 'DeepDiff ms', 'changes', 'speedup'))
+    for rules in args.rules:
+        old = make_database(rules, rng)
+        new = mutate(old, rng)
+        ours, ops = timed(lambda: cfgdiff.diff(old, new), args.iterations)
+        if DeepDiff is None:
+            print('{:>8} {:>14.3f} {:>8}'.format(rules, ours * 1000, len(ops)))
+            continue
+        theirs, result = timed(lambda: DeepDiff(old, new, ignore_order=True, exclude_regex_paths=DEEPDIFF_EXCLUDE), args.iterations)
+        changes = sum(len(paths) for paths in result.values())
+        print('{:>8} {:>14.3f} {:>8} {:>14.3f} {:>8} {:>8.1f}x'.format(rules, ours * 1000, len(ops), theirs * 1000, changes, theirs / ours))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
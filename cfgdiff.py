@@ -0,0 +1,139 @@
+"""
+Structural diff for cloud configuration documents.
+
+diff(old, new) returns a list of JSON-Patch-like operations:
+
+    {"op": "add",     "path": "/tags/env", "value": "prod"}
+    {"op": "remove",  "path": "/tags/owner", "old": "bob"}
+    {"op": "replace", "path": "/properties/status", "old": "Paused", "value": "Online"}
+
+Paths are JSON pointers, except that items of lists of objects that all
+carry a unique key field (see LIST_KEYS) are addressed by that key, e.g.
+"/properties/firewallRules/[name=AllowAll]/startIpAddress", so a rule
+moving position is not reported as a change.  Values are compared with
+their json type, so true -> 1 and 1 -> 1.0 are changes.  Identical
+subtrees are skipped without emitting operations, items of keyless lists are matched by
+their canonical json before being compared by position, and paths matching
+any of the ignore globs (IGNORE_PATHS by default) are left out.
+
+Works on Python 2 and 3.
+"""
+
+import fnmatch
+import json
+import re
+
+LIST_KEYS = ('id', 'name', 'key')
+
+# fields that change on every scan without meaning a configuration change
+IGNORE_PATHS = (
+    '*/etag',
+    '*/lastModified*',
+    '*/modifiedTime',
+    '*/*Timestamp',
+)
+
+
+def diff(old, new, ignore=IGNORE_PATHS, list_keys=LIST_KEYS):
+    ops = []
+    ignored = None
+    if ignore:
+        ignored = re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in ignore)).match
+    _diff(old, new, '', ops, ignored, list_keys)
+    return ops
+
+
+def changed_paths(ops):
+    return sorted(set(op['path'] for op in ops))
+
+
+def _escape(key):
+    return ('%s' % (key,)).replace('~', '~0').replace('/', '~1')
+
+
+def _same(old, new):
+    # old == new already holds; also require matching json types so that
+    # true -> 1 or 1 -> 1.0 is reported as a change
+    if old is new:
+        return True
+    if isinstance(old, dict):
+        return all(_same(value, new[key]) for key, value in old.items())
+    if isinstance(old, list):
+        return all(_same(a, b) for a, b in zip(old, new))
+    return isinstance(old, bool) == isinstance(new, bool) and isinstance(old, float) == isinstance(new, float)
+
+
+def _diff(old, new, path, ops, ignored, list_keys):
+    if old == new and _same(old, new):
+        return
+    if ignored is not None and path and ignored(path):
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            child = path + '/' + _escape(key)
+            if key in new:
+                _diff(old[key], new[key], child, ops, ignored, list_keys)
+            elif ignored is None or not ignored(child):
+                ops.append({'op': 'remove', 'path': child, 'old': old[key]})
+        for key in new:
+            if key not in old:
+                child = path + '/' + _escape(key)
+                if ignored is None or not ignored(child):
+                    ops.append({'op': 'add', 'path': child, 'value': new[key]})
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_list(old, new, path, ops, ignored, list_keys)
+    else:
+        ops.append({'op': 'replace', 'path': path, 'old': old, 'value': new})
+
+
+def _list_key(old, new, list_keys):
+    items = old + new
+    if not items or not all(isinstance(item, dict) for item in items):
+        return None
+    for key in list_keys:
+        if all(key in item and not isinstance(item[key], (dict, list)) for item in items) \
+                and len(set(item[key] for item in old)) == len(old) \
+                and len(set(item[key] for item in new)) == len(new):
+            return key
+    return None
+
+
+def _diff_list(old, new, path, ops, ignored, list_keys):
+    key = _list_key(old, new, list_keys)
+    if key is not None:
+        new_items = dict((item[key], item) for item in new)
+        old_keys = set()
+        for item in old:
+            old_keys.add(item[key])
+            child = '%s/[%s=%s]' % (path, key, _escape(item[key]))
+            if item[key] in new_items:
+                _diff(item, new_items[item[key]], child, ops, ignored, list_keys)
+            else:
+                ops.append({'op': 'remove', 'path': child, 'old': item})
+        for item in new:
+            if item[key] not in old_keys:
+                ops.append({'op': 'add', 'path': '%s/[%s=%s]' % (path, key, _escape(item[key])), 'value': item})
+        return
+    if len(old) == len(new):
+        for index in range(len(old)):
+            _diff(old[index], new[index], '%s/%d' % (path, index), ops, ignored, list_keys)
+        return
+    # different lengths: drop items present on both sides (by canonical
+    # json), then compare what is left position by position
+    unmatched = {}
+    for index, item in enumerate(old):
+        unmatched.setdefault(json.dumps(item, sort_keys=True), []).append(index)
+    added = []
+    for index, item in enumerate(new):
+        indexes = unmatched.get(json.dumps(item, sort_keys=True))
+        if indexes:
+            indexes.pop(0)
+        else:
+            added.append(index)
+    removed = sorted(index for indexes in unmatched.values() for index in indexes)
+    for old_index, new_index in zip(removed, added):
+        _diff(old[old_index], new[new_index], '%s/%d' % (path, new_index), ops, ignored, list_keys)
+    for old_index in removed[len(added):]:
+        ops.append({'op': 'remove', 'path': '%s/%d' % (path, old_index), 'old': old[old_index]})
+    for new_index in added[len(removed):]:
+        ops.append({'op': 'add', 'path': '%s/%d' % (path, new_index), 'value': new[new_index]})
@@ -8,7 +8,12 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+import csv
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 urllib3.disable_warnings()
 
 # set debug to 0 to enable
@@ -26,12 +31,15 @@ def parse_args():
     epilog += ' The user will be prompted for the password when the TL_USER_PW variable is not set.'
     epilog += ' The collection and namespace arguments can be suppled using the TL_CLLECTION and TL_NAMESPACE variables.'
     epilog += ' Environment variables override CLI arguments.'
+    epilog += ' With --manifest, every collection,namespace line of the file is applied in one run.'
 
     p = argparse.ArgumentParser(description=desc,epilog=epilog)
     p.add_argument('-c','--console',metavar='TL_CONSOLE', help='query the API of this Console')
     p.add_argument('-u','--user',metavar='TL_USER',help='Console username')
     p.add_argument('-l','--collection',metavar='TL_COLLECTION',help='collection to create')
     p.add_argument('-n','--namespace',metavar='TL_NAMESPACE',help='namespace to add to collection')
+    p.add_argument('-m','--manifest',metavar='FILE',help='csv of collection,namespace pairs to onboard in one batch (- for stdin)')
+    p.add_argument('-w','--workers',type=int,default=8,help='collections created/updated concurrently (default 8)')
     args = p.parse_args()
 
     # Populate args by env vars if they're set
@@ -52,10 +60,11 @@ def parse_args():
         arg_errs.append('console (-c,--console)')
     if getattr(args,'user',None) is None:
         arg_errs.append('user (-u,--user)')
-    if getattr(args,'collection',None) is None:
-        arg_errs.append('collection (-l,--collection)')
-    if getattr(args,'namespace',None) is None:
-        arg_errs.append('namespace (-n,--namespace)')
+    if getattr(args,'manifest',None) is None:
+        if getattr(args,'collection',None) is None:
+            arg_errs.append('collection (-l,--collection)')
+        if getattr(args,'namespace',None) is None:
+            arg_errs.append('namespace (-n,--namespace)')
 
     if len(arg_errs) > 0:
         err_msg = 'Missing argument(s): {}'.format(', '.join(arg_errs))
@@ -73,38 +82,41 @@ def print_debug(message):
 
 def get_token(console,user,password):
     print_debug("Getting bearer token.")
-    api = console + '/api/v1/authenticate'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    print_debug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pcc_token(user,password,console)
     bearer = "Bearer " + token
     headers = {'content-type':'application/json', 'Authorization': bearer}
     return(headers)
 
 def get_collections(console,auth_headers,collection,namespace):
+    # Returns the response unread; the body is parsed as it streams in
     print_debug("Getting collections from console.")
-    api = console + '/api/v1/collections'
-    collection_req = requests.get(api, verify=False, headers=auth_headers)
+    collection_req = pclib.get_session(console, verify=False).get('/api/v1/collections', headers=auth_headers, stream=True)
     print_debug(collection_req)
-    return collection_req.text
-
-def process_collections(namespace,collection,collections_str):
-    print_debug("Processing collections to look for duplicate.")
-    for row in (collections_str.split("\n")):
-        if (row):
-            collection_dict = json.loads(row[1:])
-            if (collection_dict['name'] == collection):
-                print_debug("Duplicate collection found, checking for duplicate namespace.")
-                if namespace not in collection_dict['namespaces']:
-                    collection_dict['namespaces'].append(namespace)
-                    print_debug("No duplicate namespace found.  Appending.")
-                    return (101, collection_dict)
-                else:
-                    print_debug("Duplicate collection with duplicate namespace found.")
-                    return (102, collection_dict)
-    collection_dict = { 
-        'namespaces' : [namespace],
+    collection_req.raise_for_status()
+    return collection_req
+
+def read_manifest(path):
+    # one collection,namespace pair per line; blank lines and # comments skipped
+    print_debug("Reading manifest " + path)
+    manifest = sys.stdin if path == '-' else open(path, newline='')
+    pairs = []
+    with manifest:
+        for row in csv.reader(manifest):
+            if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                continue
+            if len(row) != 2:
+                raise ValueError("Manifest line {} is not collection,namespace: {}".format(len(pairs) + 1, ','.join(row)))
+            pairs.append((row[0].strip(), row[1].strip()))
+    return pairs
+
+def index_collections(collections):
+    print_debug("Indexing collections by name.")
+    return {collection_dict['name']: collection_dict for collection_dict in collections}
+
+def new_collection_dict(collection,namespaces):
+    return {
+        'namespaces' : list(namespaces),
         'name' : collection,
         'functions' : ['*'],
         'codeRepos' : ['*'],
@@ -116,34 +128,58 @@ def process_collections(namespace,collection,collections_str):
         'labels' : ['*'],
         'appIDs' : ['*']
     }
-    print_debug("No collection found.  Will need to make one.")
-    return (100, collection_dict)
-
-def process_vuln_deployed_pol(collection,vuln_deployed_pol_str):
-    print_debug("Analyze current Deployed Image Vulnerability rules to see if duplicate exists.")
-    deploy_vulns_dict = json.loads(vuln_deployed_pol_str)
-    for top_key in deploy_vulns_dict.keys():
-        if (top_key == 'rules'):
-            rule_exists = 100
-            for rule in (deploy_vulns_dict[top_key]):
-                if ((rule['name']) == collection):
-                    print_debug("Duplicate rule exists.  No need to create.")
-                    rule_exists = 0
-    if (rule_exists != 0):
-        print_debug("Rule doesn't exist.  Will need to create new and add collection to scope.")
-        new_rule_pol = {
+
+def process_collections(collections,pairs):
+    # Plan every change against the indexed collections in memory.  Returns
+    # {collection: (status, collection_dict)} with status 100 (create),
+    # 101 (add namespaces to an existing collection) or 102 (nothing to do);
+    # several namespaces for one collection become a single create/update.
+    print_debug("Processing collections to look for duplicates.")
+    plan = {}
+    for collection, namespace in pairs:
+        if collection in plan:
+            status, collection_dict = plan[collection]
+        elif collection in collections:
+            status, collection_dict = 102, dict(collections[collection])
+            collection_dict['namespaces'] = list(collection_dict.get('namespaces') or [])
+        else:
+            status, collection_dict = 100, new_collection_dict(collection, [])
+        if namespace not in collection_dict['namespaces']:
+            collection_dict['namespaces'].append(namespace)
+            if status == 102:
+                status = 101
+        plan[collection] = (status, collection_dict)
+    return plan
+
+def process_vuln_deployed_pol(collections,deploy_vulns_dict):
+    # One pass over the policy: index the rules by name, then put a
+    # collection-scoped rule for every collection without one at the top.
+    # Returns (names of the rules added, policy dict)
+    print_debug("Analyze current Deployed Image Vulnerability rules to see if duplicates exist.")
+    rules = deploy_vulns_dict.get('rules') or []
+    rule_names = set(rule['name'] for rule in rules)
+    new_rules = []
+    for collection in collections:
+        if collection in rule_names:
+            print_debug("Duplicate rule {} exists.  No need to create.".format(collection))
+            continue
+        rule_names.add(collection)
+        new_rules.append({
             'name' : collection,
             'collections' : [ { 'name' : collection } ],
             'effect' : 'alert'
-        }
-        print_debug("Adding new rule to top of policy json.")
-        deploy_vulns_dict['rules'].insert(0, new_rule_pol)
-    return (rule_exists, deploy_vulns_dict)
+        })
+    if new_rules:
+        print_debug("Adding {} new rules to top of policy json.".format(len(new_rules)))
+        deploy_vulns_dict['rules'] = new_rules + rules
+    return ([rule['name'] for rule in new_rules], deploy_vulns_dict)
+
+def policy_digest(policy):
+    return hashlib.sha256(json.dumps(policy, sort_keys=True).encode()).hexdigest()
 
 def new_collection(console,auth_headers,payload):
     print_debug("Creating new collection.")
-    api = console + '/api/v1/collections'
-    response = requests.post(api, headers=auth_headers, data=json.dumps(payload), verify=False)
+    response = pclib.get_session(console, verify=False).post('/api/v1/collections', headers=auth_headers, data=json.dumps(payload))
     print_debug(response)
     if response.ok:
         return 0
@@ -153,63 +189,126 @@ def new_collection(console,auth_headers,payload):
 def update_collection(console,auth_headers,collection,payload):
     print_debug("Updating existing collection.")
     collection = urllib.parse.quote(collection)
-    api = console + '/api/v1/collections/' + collection
-    response = requests.put(api, headers=auth_headers, data=json.dumps(payload), verify=False)
+    api = '/api/v1/collections/' + collection
+    response = pclib.get_session(console, verify=False).put(api, headers=auth_headers, data=json.dumps(payload))
     print_debug(response)
     if response.ok:
         return 0
     else:
         return 1
 
-def get_vuln_deployed_pol(console,auth_headers,collection):
+def get_vuln_deployed_pol(console,auth_headers):
+    # Returns (policy dict, ETag or None)
     print_debug("Get current Deployed Image Vulnerability rules.")
-    collection = urllib.parse.quote(collection)
-    api = console + '/api/v1/policies/vulnerability/images'
-    deployed_vuln_pol_req = requests.get(api, verify=False, headers=auth_headers)
+    api = '/api/v1/policies/vulnerability/images'
+    deployed_vuln_pol_req = pclib.get_session(console, verify=False).request_retry('GET', api, headers=auth_headers)
     print_debug(deployed_vuln_pol_req)
-    return deployed_vuln_pol_req.text
+    deployed_vuln_pol_req.raise_for_status()
+    return (deployed_vuln_pol_req.json(), deployed_vuln_pol_req.headers.get('ETag'))
 
-def update_vuln_deployed_pol(console,auth_headers,payload):
+def update_vuln_deployed_pol(console,auth_headers,payload,etag=None):
+    # Returns the status code; 412 means the policy changed since it was read
     print_debug("Updating Deployed Image Vulnerability rules with new matching collection scope.")
-    api = console + '/api/v1/policies/vulnerability/images'
-    response = requests.put(api, headers=auth_headers, data=json.dumps(payload), verify=False)
+    api = '/api/v1/policies/vulnerability/images'
+    headers = dict(auth_headers)
+    if etag:
+        headers['If-Match'] = etag
+    response = pclib.get_session(console, verify=False).put(api, headers=headers, data=json.dumps(payload))
     print_debug(response)
-    if response.ok:
-        return 0
-    else:
-        return 1
-    return 0
+    return response.status_code
+
+def add_vuln_deployed_rules(console,auth_headers,collections,attempts=3):
+    # Read-modify-write of the whole policy with one PUT for every new
+    # rule.  The write is conditional on nobody else having changed the
+    # policy since it was read: with If-Match when the console sends an
+    # ETag, otherwise by re-reading it and comparing hashes just before the
+    # PUT.  On a conflict the rules are merged again into a fresh copy.
+    # Returns (status, rules added) with status 0 ok / 1 failed
+    for attempt in range(attempts):
+        policy, etag = get_vuln_deployed_pol(console,auth_headers)
+        digest = policy_digest(policy)
+        added, policy = process_vuln_deployed_pol(collections,policy)
+        if not added:
+            return (0, [])
+        if not etag:
+            current, etag = get_vuln_deployed_pol(console,auth_headers)
+            if policy_digest(current) != digest:
+                print_debug("Deployed Image Vulnerability policy changed while merging, retrying.")
+                continue
+        status = update_vuln_deployed_pol(console,auth_headers,policy,etag)
+        if status == 412:
+            print_debug("Deployed Image Vulnerability policy changed before the update, retrying.")
+            continue
+        return (0 if 200 <= status < 300 else 1, added)
+    print("Deployed Image Vulnerability policy kept changing, gave up after {} attempts".format(attempts))
+    return (1, [])
+
+def apply_collections(console,auth_headers,plan,workers=8):
+    # creates and updates are independent, so they run concurrently
+    # Returns {collection: 0 ok / 1 failed} for every collection changed
+    results = {}
+    lock = threading.Lock()
+    def apply(collection,status,collection_dict):
+        try:
+            if status == 100:
+                result = new_collection(console,auth_headers,collection_dict)
+            else:
+                result = update_collection(console,auth_headers,collection,collection_dict)
+        except OSError as e:
+            print("Error applying collection {}: {}".format(collection, e))
+            result = 1
+        with lock:
+            results[collection] = result
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for collection, (status, collection_dict) in plan.items():
+            if status in (100, 101):
+                pool.submit(apply,collection,status,collection_dict)
+    return results
 
 def main():
     # load argumants
     args = parse_args()
+    # collection/namespace pairs to onboard, from the manifest or the command line
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+    else:
+        pairs = [(args.collection, args.namespace)]
     # return bearer token
+    pclib.get_session(args.console, verify=False, pool_size=args.workers)
     headers = get_token(args.console,args.user,args.password)
-    # return all collections structured as json in string
-    collections_json = get_collections(args.console,headers,args.collection,args.namespace)
-    # process collections, comparing to desired new collection and namespace
-    col_status, collection_update_dict = process_collections(args.namespace,args.collection,collections_json[:-1])
-    # based on col_status, either create new collection with namespace (100) or add namespace to existing collection (101)
-    if col_status == 100:
-        if (new_collection(args.console,headers,collection_update_dict) != 0):
-            print("Error creating new collection")
-            sys.exit(1)
-    elif col_status == 101:
-        if (update_collection(args.console,headers,args.collection,collection_update_dict) != 0):
-            print("Error add namespace to existing collection")
-            sys.exit(1)
-    else:
-        print("Collection exists with namespace already added.")
-    # return all vulnerability image deployed rules as string
-    vuln_pol_json = get_vuln_deployed_pol(args.console,headers,args.collection)
-    # process the rules to see if we need to add a new one for the new collection
-    vuln_dep_status, vuln_deployed_pol_dict = process_vuln_deployed_pol(args.collection,vuln_pol_json)
-    # based on the vuln_dep_status, add new rule to the deployed images vuln policy
-    if vuln_dep_status == 100:
-        if (update_vuln_deployed_pol(args.console,headers,vuln_deployed_pol_dict) != 0):
-            print("Error adding new rule to Deployed Vulnerabilities policy")
-            sys.exit(1)
+    # stream all collections from the console, indexed once by name
+    collections_req = get_collections(args.console,headers,args.collection,args.namespace)
+    collections = index_collections(pclib.iter_json_array(collections_req))
+    # compare every desired collection and namespace to the index
+    plan = process_collections(collections,pairs)
+    # create new collections (100) and add namespaces to existing ones (101)
+    results = apply_collections(args.console,headers,plan,args.workers)
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    for collection, (status, collection_dict) in plan.items():
+        if status == 102:
+            counts['unchanged'] += 1
+            print_debug("Collection {} exists with namespace already added.".format(collection))
+        elif results.get(collection) == 0:
+            counts['created' if status == 100 else 'updated'] += 1
+        else:
+            counts['failed'] += 1
+            if status == 100:
+                print("Error creating new collection {}".format(collection))
+            else:
+                print("Error add namespace to existing collection {}".format(collection))
+    print("{} collections: {created} created, {updated} updated, {unchanged} unchanged, {failed} failed".format(len(plan), **counts))
+    failed = counts['failed']
+    if failed:
+        sys.exit(1)
+    # add a rule for every collection that lacks one with a single policy update
+    vuln_dep_status, added = add_vuln_deployed_rules(args.console,headers,list(plan))
+    if vuln_dep_status != 0:
+        print("Error adding new rules to Deployed Vulnerabilities policy")
+        sys.exit(1)
+    print_debug("Added {} rules to Deployed Vulnerabilities policy".format(len(added)))
     print_debug("Success")
+    if debug == 0:
+        pclib.print_session_stats()
     return 0
 
 if __name__ == '__main__':
@@ -1,5 +1,16 @@
 import pclib
+import argparse
 import configparser
+import sys
+
+####################################################################
+# Output options
+####################################################################
+parser = argparse.ArgumentParser(description='Execute a config RQL query')
+parser.add_argument('-o', '--output', help='write results to this file instead of stdout')
+parser.add_argument('-f', '--format', choices=['csv', 'json'], default='csv', help='csv, or one json object per line')
+parser.add_argument('--page-size', type=int, default=pclib.RQL_PAGE_SIZE, help='rows fetched per page')
+args = parser.parse_args()
 
 ####################################################################
 # Read In config.ini
@@ -40,6 +51,8 @@ jwt = pclib.get_pc_token(user,pw,api)
 rql = input("Config RQL: ")
 
 ####################################################################
-# Get RQL Response
+# Stream RQL Response
 ####################################################################
-print(pclib.get_rql_csv(jwt,rql,api))
\ No newline at end of file
+out = open(args.output, 'w', newline='') if args.output else sys.stdout
+pclib.write_rql(jwt,rql,api,out,fmt=args.format,page_size=args.page_size)
+if args.output: out.close()
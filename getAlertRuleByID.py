@@ -8,7 +8,9 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 urllib3.disable_warnings()
 
 # Set debug to 0 for logging
@@ -19,7 +21,12 @@ def parse_args():
     parser.add_argument('--pc_console', dest='pcConsole', type=str, help='Prisma Cloud API URL', required=True)
     parser.add_argument('--api_key', dest='apiKey', type=str, help='API Key', required=True)
     parser.add_argument('--api_secret', dest='apiSecret', type=str, help='API Secret')
-    parser.add_argument('--alert_rule_id', dest='alertRuleID', type=str, help='Alert Rule ID', required=True)
+    rules = parser.add_mutually_exclusive_group(required=True)
+    rules.add_argument('--alert_rule_id', dest='alertRuleID', type=str, help='Alert Rule ID')
+    rules.add_argument('--alert_rule_ids', dest='alertRuleIDs', type=str, help='File of Alert Rule IDs, one per line, or - for stdin')
+    rules.add_argument('--all', dest='all', action='store_true', help='Fetch every alert rule')
+    parser.add_argument('--workers', dest='workers', type=int, default=8, help='Alert rules fetched concurrently')
+    parser.add_argument('--cache', dest='cache', type=str, help='Alert rule cache (default ~/.prismacloud/alert_rules.json)')
     args = parser.parse_args()
     if getattr(args,'apiSecret',None) is None:
         args.api_secret = getpass.getpass('Enter password: ')
@@ -32,30 +39,119 @@ def printDebug(message):
 
 def getPCToken(console,user,password):
     printDebug("\nGetting PC bearer token.")
-    api = console + '/login'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pc_token(user,password,console)
     return(token)
 
-def getAlertRule(console,token,alertRuleID):
-    printDebug("\nGetting Alert Rule.")
+def getAlertRule(console,token,alertRuleID,cached=None):
+    # Conditional GET: with a cached entry the console can answer 304 and
+    # the cached rule is reused.  Returns (entry, fetched).
+    printDebug("\nGetting Alert Rule " + alertRuleID)
+    headers = {
+        'content-type':'application/json',
+        'x-redlock-auth': token
+    }
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('lastModified'):
+        headers['If-Modified-Since'] = cached['lastModified']
+    response = pclib.get_session(console).request_retry('GET', '/alert/rule/' + alertRuleID, headers=headers)
+    printDebug(response)
+    if response.status_code == 304 and cached:
+        return (cached, False)
+    response.raise_for_status()
+    return (alertRuleEntry(response.json(), response.headers), True)
+
+def alertRuleEntry(rule,headers=None):
+    headers = headers or {}
+    return {
+        'etag': headers.get('ETag'),
+        'lastModified': headers.get('Last-Modified'),
+        'lastModifiedOn': rule.get('lastModifiedOn'),
+        'rule': rule
+    }
+
+def listAlertRules(console,token):
+    printDebug("\nListing Alert Rules.")
     headers = {
         'content-type':'application/json',
         'x-redlock-auth': token
     }
-    api = console + '/alert/rule/' + alertRuleID
-    response = requests.get(api, headers=headers)
+    response = pclib.get_session(console).request_retry('GET', '/alert/rule', headers=headers)
     printDebug(response)
-    return (response.text)
+    response.raise_for_status()
+    return response.json()
+
+def readAlertRuleIDs(path):
+    ids = sys.stdin if path == '-' else open(path)
+    alertRuleIDs = [line.strip() for line in ids if line.strip()]
+    if path != '-':
+        ids.close()
+    return list(dict.fromkeys(alertRuleIDs))
+
+def getAlertRules(console,token,alertRuleIDs,cache,workers,listed=None):
+    # Fetch rules concurrently.  Rules in the GET /alert/rule listing are
+    # taken from it: the cached entry is kept when its lastModifiedOn
+    # matches, otherwise the listed body replaces it.  Only rules missing
+    # from the listing go out as conditional GETs.  Returns the rules in
+    # input order and updates cache in place.
+    listed = listed or {}
+    results = {}
+    toFetch = []
+    fetched = 0
+    for alertRuleID in alertRuleIDs:
+        cached = cache.get(alertRuleID)
+        rule = listed.get(alertRuleID)
+        if rule is None:
+            toFetch.append(alertRuleID)
+        elif cached and cached.get('lastModifiedOn') == rule.get('lastModifiedOn'):
+            results[alertRuleID] = cached
+        else:
+            results[alertRuleID] = cache[alertRuleID] = alertRuleEntry(rule)
+            fetched += 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(getAlertRule,console,token,alertRuleID,cache.get(alertRuleID)): alertRuleID for alertRuleID in toFetch}
+        for future in as_completed(futures):
+            entry, changed = future.result()
+            results[futures[future]] = entry
+            cache[futures[future]] = entry
+            fetched += changed
+    print("{} alert rules: {} fetched, {} unchanged".format(len(alertRuleIDs), fetched, len(alertRuleIDs) - fetched), file=sys.stderr)
+    return [results[alertRuleID]['rule'] for alertRuleID in alertRuleIDs]
 
 def main():
     args = parse_args()
     pcToken = getPCToken(args.pcConsole,args.apiKey,args.apiSecret)
     printDebug (pcToken)
-    alertRuleText = getAlertRule (args.pcConsole,pcToken,args.alertRuleID)
-    print(alertRuleText)
+    cachePath = args.cache or pclib.state_path('alert_rules.json')
+    # --all takes every rule body from one listing request; the cache is
+    # only refreshed from it for later runs.  --alert_rule_ids and
+    # --alert_rule_id skip the listing and send one conditional GET per
+    # rule, so cached rules cost a 304 instead of a body whenever the
+    # console returns ETag or Last-Modified.
+    listed = {}
+    if args.all:
+        for rule in listAlertRules(args.pcConsole,pcToken):
+            listed[rule['policyScanConfigId']] = rule
+        alertRuleIDs = list(listed)
+    elif args.alertRuleIDs:
+        alertRuleIDs = readAlertRuleIDs(args.alertRuleIDs)
+    else:
+        alertRuleIDs = [args.alertRuleID]
+    consoleKey = pclib.state_key(args.pcConsole.rstrip('/'), args.apiKey)
+    cache = pclib.load_state(cachePath).get(consoleKey, {})
+    rules = getAlertRules(args.pcConsole,pcToken,alertRuleIDs,cache,args.workers,listed)
+    with pclib.file_lock(cachePath):
+        state = pclib.load_state(cachePath)
+        state.setdefault(consoleKey, {}).update(cache)
+        pclib.save_state(cachePath, state)
+    if args.alertRuleID:
+        print(json.dumps(rules[0]))
+    else:
+        for rule in rules:
+            print(json.dumps(rule))
+    if debug == 0:
+        pclib.print_session_stats()
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -8,22 +8,97 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
+import datetime
+import time
+import heapq
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 urllib3.disable_warnings()
 
 # Set debug to 0 for logging
 debug = 1
 
+ALERT_FIELDS = ['alert.id', 'alert.status', 'alert.time']
+# v2 alert items carry alert.* fields at the top level of each item
+ALERT_FIELD_PATHS = {'alert.id': 'id', 'alert.status': 'status', 'alert.time': 'alertTime'}
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Connect Infomration')
     parser.add_argument('--pc_console', dest='pcConsole', type=str, help='Prisma Cloud API URL', required=True)
     parser.add_argument('--api_key', dest='apiKey', type=str, help='API Key', required=True)
     parser.add_argument('--api_secret', dest='apiSecret', type=str, help='API Secret')
+    parser.add_argument('--output', dest='output', type=str, help='Write alerts to this file instead of stdout (required for parquet)')
+    parser.add_argument('--format', dest='format', choices=['ndjson', 'csv', 'parquet'], default='ndjson', help='Output format')
+    parser.add_argument('--page_size', dest='pageSize', type=int, default=1000, help='Alerts fetched per page')
+    parser.add_argument('--fields', dest='fields', type=str, default=','.join(ALERT_FIELDS), help='Comma separated alert fields to request')
+    parser.add_argument('--detailed', dest='detailed', action='store_true', help='Request detailed alerts')
+    parser.add_argument('--time_amount', dest='timeAmount', type=int, default=7, help='Relative window size (default 7)')
+    parser.add_argument('--time_unit', dest='timeUnit', type=str, default='day', help='Relative window unit: minute, hour, day, week, month, year')
+    parser.add_argument('--start', dest='start', type=str, help='Absolute window start, epoch ms or ISO-8601 UTC (overrides the relative window)')
+    parser.add_argument('--end', dest='end', type=str, help='Absolute window end, epoch ms or ISO-8601 UTC (default now)')
+    parser.add_argument('--sync', dest='sync', action='store_true', help='Fetch only alerts updated since the last sync, upsert them into the local store and print status changes')
+    parser.add_argument('--store', dest='store', type=str, help='Alert store for --sync (default ~/.prismacloud/alerts.db)')
+    parser.add_argument('--parallel', dest='parallel', type=int, default=0, help='Split the --start/--end window into time slices fetched by this many workers')
+    parser.add_argument('--slice_hours', dest='sliceHours', type=float, default=24, help='Initial slice length for --parallel')
+    parser.add_argument('--max_slice_alerts', dest='maxSliceAlerts', type=int, default=10000, help='Slices with more alerts than this are halved')
     args = parser.parse_args()
     if getattr(args,'apiSecret',None) is None:
         args.api_secret = getpass.getpass('Enter password: ')
+    if args.sync and (args.parallel or args.format != 'ndjson'):
+        parser.error('--sync writes an ndjson change feed and cannot be combined with --parallel or --format')
+    if args.parallel and not args.start:
+        parser.error('--parallel needs an absolute --start window')
+    if args.format == 'parquet' and not args.output:
+        parser.error('--format parquet needs --output')
+    args.fields = [field.strip() for field in args.fields.split(',') if field.strip()]
     return args
 
+def parseTime(value):
+    # epoch milliseconds, or an ISO-8601 date/datetime taken as UTC
+    if value.isdigit():
+        return int(value)
+    when = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return int(when.timestamp() * 1000)
+
+def buildAlertQuery(args):
+    if args.start:
+        end = parseTime(args.end) if args.end else int(time.time() * 1000)
+        timeRange = {
+          "type": "absolute",
+          "value": {
+            "startTime": parseTime(args.start),
+            "endTime": end
+          }
+        }
+    else:
+        timeRange = {
+          "relativeTimeType": "BACKWARD",
+          "type": "relative",
+          "value": {
+            "amount": args.timeAmount,
+            "unit": args.timeUnit
+          }
+        }
+    query = {
+        "detailed": "true" if args.detailed else "false",
+        "fields": args.fields,
+        "filters": [
+          {
+            "name":"timeRange.type",
+            "operator":"=",
+            "value":"ALERT_UPDATED"
+          }
+        ],
+        "limit": args.pageSize,
+        "timeRange": timeRange
+    }
+    return query
+
 def printDebug(message):
     if debug == 0:
         print(message)
@@ -31,53 +106,192 @@ def printDebug(message):
 
 def getPCToken(console,user,password):
     printDebug("\nGetting PC bearer token.")
-    api = console + '/login'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pc_token(user,password,console)
     return(token)
 
-def getAlertsV2(console,token):
-    printDebug("\nGetting Alerts.")
+def getAlertPage(console,token,query):
     headers = {
         'content-type':'application/json',
-        'x-redlock-auth': token
-    }
-    url = console + '/v2/alert'
-    query = {
-        "detailed": "false",
-        "fields": [
-          "alert.id",
-          "alert.status",
-          "alert.time"
-        ],
-        "filters": [
-          {
-            "name":"timeRange.type",
-            "operator":"=",
-            "value":"ALERT_UPDATED"
-          }
-        ],
-        "timeRange": {
-          "relativeTimeType": "BACKWARD",
-          "type": "relative",
-          "value": {
-            "amount": 7,
-            "unit": "day"
-          }
-        }
+        'x-redlock-auth': token() if callable(token) else token
     }
-    response = requests.post(url, headers=headers, json=query)
+    response = pclib.get_session(console).request_retry('POST', '/v2/alert', headers=headers, json=query)
     printDebug(response)
-    return (response.text)
+    response.raise_for_status()
+    return response.json()
+
+def getAlertsV2(console,token,query):
+    # Generator over every alert matching query, one page at a time via
+    # the v2 nextPageToken cursor.  token may be a function returning a
+    # current token so long exports survive token expiry.
+    printDebug("\nGetting Alerts.")
+    query = dict(query)
+    while True:
+        page = getAlertPage(console,token,query)
+        for alert in page.get('items') or []:
+            yield alert
+        if not page.get('nextPageToken'):
+            return
+        query['pageToken'] = page['nextPageToken']
+
+def alertUpdatedTime(alert):
+    # slices are cut on the ALERT_UPDATED time range, so they are ordered
+    # on the same key; alerts never updated carry only their alert time
+    return alert.get('lastUpdated') or alert.get('alertTime') or 0
+
+def fetchAlertSlice(console,token,query,start,end,maxAlerts,minSlice):
+    # Fetch one absolute [start, end] slice.  Returns None when the slice
+    # holds more than maxAlerts and can still be halved, otherwise a
+    # spooled ndjson file of the slice's alerts sorted by update time.
+    query = dict(query)
+    query['timeRange'] = {"type": "absolute", "value": {"startTime": start, "endTime": end}}
+    page = getAlertPage(console,token,query)
+    if (page.get('totalRows') or 0) > maxAlerts and end - start > minSlice:
+        return None
+    alerts = list(page.get('items') or [])
+    while page.get('nextPageToken'):
+        query['pageToken'] = page['nextPageToken']
+        page = getAlertPage(console,token,query)
+        alerts.extend(page.get('items') or [])
+    alerts.sort(key=alertUpdatedTime)
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024, mode='w+')
+    for alert in alerts:
+        spool.write(json.dumps(alert) + "\n")
+    spool.seek(0)
+    return spool
+
+def getAlertsSliced(console,token,query,start,end,sliceMs,workers,maxAlerts,minSlice,retries=3):
+    # Split [start, end] into slices fetched in parallel.  Dense slices
+    # are halved until they hold at most maxAlerts; a failed slice is
+    # retried on its own while finished slices wait on disk.  Alerts come
+    # out in slice order, so in update-time order overall, with
+    # duplicates (same alert.id) dropped.
+    query = dict(query)
+    if 'alert.id' not in query['fields']:
+        query['fields'] = query['fields'] + ['alert.id']
+    pending = []
+    finished = {}
+    seen = set()
+    stats = {'slices': 0, 'splits': 0, 'retries': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        def submit(sliceStart, sliceEnd, attempt=0):
+            heapq.heappush(pending, (sliceStart, sliceEnd))
+            future = pool.submit(fetchAlertSlice,console,token,query,sliceStart,sliceEnd,maxAlerts,minSlice)
+            futures[future] = (sliceStart, sliceEnd, attempt)
+        sliceStart = start
+        while sliceStart < end:
+            submit(sliceStart, min(sliceStart + sliceMs, end))
+            sliceStart += sliceMs
+        while futures:
+            done, notDone = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                sliceStart, sliceEnd, attempt = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if attempt >= retries:
+                        raise
+                    stats['retries'] += 1
+                    printDebug("Slice {}-{} failed ({}), retrying".format(sliceStart, sliceEnd, e))
+                    pending.remove((sliceStart, sliceEnd))
+                    heapq.heapify(pending)
+                    time.sleep(2 ** attempt)
+                    submit(sliceStart, sliceEnd, attempt + 1)
+                    continue
+                if result is None:
+                    stats['splits'] += 1
+                    pending.remove((sliceStart, sliceEnd))
+                    heapq.heapify(pending)
+                    middle = (sliceStart + sliceEnd) // 2
+                    submit(sliceStart, middle)
+                    submit(middle, sliceEnd)
+                    continue
+                stats['slices'] += 1
+                finished[(sliceStart, sliceEnd)] = result
+            while pending and pending[0] in finished:
+                spool = finished.pop(heapq.heappop(pending))
+                for line in spool:
+                    alert = json.loads(line)
+                    if alert.get('id') not in seen:
+                        seen.add(alert.get('id'))
+                        yield alert
+                spool.close()
+    printDebug("Fetched {} slices ({} splits, {} retries)".format(stats['slices'], stats['splits'], stats['retries']))
+
+SYNC_OVERLAP_MS = 60000
+
+def openAlertStore(path):
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("CREATE TABLE IF NOT EXISTS alerts (tenant TEXT, id TEXT, status TEXT, time INTEGER, policy TEXT, PRIMARY KEY (tenant, id))")
+    db.execute("CREATE INDEX IF NOT EXISTS alerts_status ON alerts (tenant, status)")
+    db.execute("CREATE INDEX IF NOT EXISTS alerts_time ON alerts (tenant, time)")
+    db.execute("CREATE TABLE IF NOT EXISTS marks (tenant TEXT PRIMARY KEY, high_water INTEGER)")
+    return db
+
+def syncAlerts(console,token,query,db,tenant,out):
+    # Ask only for alerts updated since the tenant's high-water mark (less
+    # a small overlap), upsert them, and write one ndjson change record
+    # per new alert or status transition.  The mark only moves once the
+    # whole delta is stored.
+    now = int(time.time() * 1000)
+    mark = db.execute("SELECT high_water FROM marks WHERE tenant = ?", (tenant,)).fetchone()
+    query = dict(query)
+    query['fields'] = list(dict.fromkeys(query['fields'] + ['alert.id', 'alert.status', 'alert.time', 'policy.name']))
+    if mark:
+        query['timeRange'] = {"type": "absolute", "value": {"startTime": mark[0] - SYNC_OVERLAP_MS, "endTime": now}}
+    counts = {'fetched': 0, 'new': 0, 'status': 0}
+    for alert in getAlertsV2(console,token,query):
+        counts['fetched'] += 1
+        alertId = alert.get('id')
+        status = alert.get('status')
+        policy = pclib.get_path(alert, 'policy.name') or alert.get('policyId')
+        stored = db.execute("SELECT status FROM alerts WHERE tenant = ? AND id = ?", (tenant, alertId)).fetchone()
+        if stored and stored[0] == status:
+            continue
+        db.execute("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)", (tenant, alertId, status, alert.get('alertTime'), policy))
+        change = {'id': alertId, 'change': 'status' if stored else 'new', 'from': stored[0] if stored else None, 'to': status, 'time': alert.get('alertTime'), 'policy': policy}
+        counts[change['change']] += 1
+        out.write(json.dumps(change) + "\n")
+    db.execute("INSERT OR REPLACE INTO marks VALUES (?, ?)", (tenant, now))
+    db.commit()
+    return counts
 
 def main():
     args = parse_args()
     pcToken = getPCToken(args.pcConsole,args.apiKey,args.apiSecret)
     printDebug (pcToken)
-    alerttext = getAlertsV2 (args.pcConsole,pcToken)
-    print(alerttext)
+    token = lambda: pclib.get_pc_token(args.apiKey,args.apiSecret,args.pcConsole)
+    query = buildAlertQuery(args)
+    if args.sync:
+        db = openAlertStore(args.store or pclib.state_path('alerts.db'))
+        out = open(args.output, 'a') if args.output else sys.stdout
+        # one stack serves many tenants, so the mark and the stored alerts
+        # belong to the console and access key together
+        tenant = pclib.state_key(args.pcConsole.rstrip('/'), args.apiKey)
+        counts = syncAlerts(args.pcConsole,token,query,db,tenant,out)
+        if args.output:
+            out.close()
+        db.close()
+        printDebug("Fetched {fetched} alerts: {new} new, {status} status changes".format(**counts))
+        return 0
+    if args.parallel:
+        timeRange = query['timeRange']['value']
+        alerts = getAlertsSliced(args.pcConsole,token,query,timeRange['startTime'],timeRange['endTime'],
+            int(args.sliceHours * 3600000),args.parallel,args.maxSliceAlerts,60000)
+    else:
+        alerts = getAlertsV2(args.pcConsole,token,query)
+    columns = [ALERT_FIELD_PATHS.get(field, field) for field in args.fields]
+    if args.format == 'parquet':
+        count = pclib.write_rows(alerts,args.output,'parquet',columns)
+    else:
+        out = open(args.output, 'w', newline='') if args.output else sys.stdout
+        count = pclib.write_rows(alerts,out,'csv' if args.format == 'csv' else 'json',columns)
+        if args.output:
+            out.close()
+    printDebug("Wrote " + str(count) + " alerts")
+    if debug == 0:
+        pclib.print_session_stats()
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
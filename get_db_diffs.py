@@ -1,9 +1,19 @@
+#!/usr/bin/env python3
+
+import argparse
 import getpass
-import requests
+import gzip
+import hashlib
 import json
+import os
 import pprint
-from deepdiff import DeepDiff
-from __builtin__ import raw_input
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import pclib
+import cfgdiff
 
 stacks = [
     'https://api.prismacloud.io',
@@ -11,125 +21,321 @@ stacks = [
     'https://api3.prismacloud.io'
 ]
 
+DEFAULT_API_NAME = 'azure-sql-db-list'
+# resources are listed as of now, whenever they were first seen
+SEARCH_TIME_RANGE = {"type": "to_now", "value": "epoch"}
 
-def read_credentials():
-    name = raw_input("Username: ")
-    pw = getpass.getpass()
-    return ([name, pw])
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Show configuration drift for any config resource type')
+    parser.add_argument('--stack', help='Prisma Cloud API URL (prompted when missing)')
+    parser.add_argument('--user', help='Access key / username (prompted when missing)')
+    parser.add_argument('--tenant', help='Tenant (customerName) to log in to (prompted when there are several)')
+    parser.add_argument('--api-name', default=DEFAULT_API_NAME, help='api.name of the resources to diff (default %(default)s)')
+    parser.add_argument('--rql', help='config RQL selecting the resources to diff (overrides --api-name)')
+    parser.add_argument('--rrn', help='diff this one resource without listing or prompting')
+    parser.add_argument('--fleet', action='store_true', help='diff every matching resource non-interactively and print a drift summary')
+    parser.add_argument('--history', action='store_true', help='with --fleet or --rrn, diff every state change instead of only the latest')
+    parser.add_argument('--format', choices=['text', 'ndjson'], default='text', help='with --fleet or --rrn, ndjson writes one json line of diffs per resource')
+    parser.add_argument('--page-size', type=int, default=pclib.RQL_PAGE_SIZE, help='resources fetched per search page')
+    parser.add_argument('--workers', type=int, default=8, help='resources diffed concurrently')
+    parser.add_argument('--rate', type=float, default=10.0, help='maximum API requests per second to the console')
+    parser.add_argument('--ignore', action='append', default=[], help='glob of json paths to leave out of diffs, e.g. "*/provisioningState" (repeatable)')
+    parser.add_argument('--no-default-ignore', action='store_true', help='also diff etags and timestamps')
+    parser.add_argument('--cache-dir', default=pclib.state_path('snapshots'), help='raw snapshot cache directory')
+    parser.add_argument('--cache-mb', type=int, default=512, help='raw snapshot cache size cap in MB (0 disables the cache)')
+    args = parser.parse_args(argv)
+    if args.fleet and args.rrn:
+        parser.error('--fleet and --rrn are exclusive')
+    args.interactive = not (args.fleet or args.rrn)
+    args.rql = args.rql or pclib.api_name_rql(args.api_name)
+    return args
 
-def get_stack():
-    stack_number = 1
-    for stack in stacks:
-        print stack_number, stacks[stack_number - 1]
-        stack_number += 1
-    stack_index = int(raw_input("Select Stack: "))
-    stack_index -= 1
-    return stacks[stack_index]
-
-
-def get_jwt(j_name, j_pw, j_api_stack):
-    url = j_api_stack + "/login"
-    payload = "{\"username\":\"" + j_name + "\",\"password\":\"" + j_pw + "\"}"
-    headers = {
-        'accept': "application/json; charset=UTF-8",
-        'content-type': "application/json; charset=UTF-8"
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    jwt_json = json.loads(response.text)
-    customer_number = 1
-    for customer in jwt_json["customerNames"]:
-        print customer_number,
-        customer_number += 1
-        print (customer["customerName"])
-    tenant_index = int(raw_input("Select Tenant: "))
-    tenant_index -= 1
-    tenant = jwt_json["customerNames"][tenant_index]["customerName"]
-    payload = "{\"username\":\"" + j_name + "\",\"password\":\"" + j_pw + "\",\"customerName\":\"" + tenant + "\"}"
-    headers = {
-        'accept': "application/json; charset=UTF-8",
-        'content-type': "application/json; charset=UTF-8"
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    jwt_json = json.loads(response.text)
-    return jwt_json["token"]
+
+limiter = None
 
 
-def get_db_rrn(d_jwt, d_api_stack):
-    url = d_api_stack + "/search/config"
-    payload = "{\"timeRange\":{\"type\":\"to_now\",\"value\":\"epoch\"},\"query\":\"config where api.name = 'azure-sql-db-list' \"}"
+def post(stack, path, payload, token):
+    # every API call goes through the shared keep-alive session, paced by
+    # the --rate limiter and retried on 429/5xx
     headers = {
         'accept': "application/json; charset=UTF-8",
         'content-type': "application/json; charset=UTF-8",
-        'x-redlock-auth': d_jwt
+        'x-redlock-auth': token() if callable(token) else token
     }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    sql_db_json = json.loads(response.text)
-    sql_db_count = sql_db_json["data"]["totalRows"]
-    db_counter = 0
-    while db_counter < sql_db_count:
-        print db_counter + 1, sql_db_json["data"]["items"][db_counter]["name"]
-        db_counter += 1
-    db_index = int(raw_input("Select DB: ")) - 1
-    return sql_db_json["data"]["items"][db_index]["rrn"]
+    return pclib.get_session(stack).request_retry('POST', path, limiter=limiter, headers=headers, data=json.dumps(payload))
+
+
+def read_credentials(name=None):
+    name = name or input("Username: ")
+    pw = os.environ.get('PC_PASSWORD') or getpass.getpass()
+    return ([name, pw])
+
+
+def get_stack():
+    for stack_number, stack in enumerate(stacks, 1):
+        print(stack_number, stack)
+    stack_index = int(input("Select Stack: "))
+    return stacks[stack_index - 1]
+
+
+def get_tenant(name, pw, api_stack, interactive=True):
+    # a tenant-less login is tried through the token cache first, so
+    # single-tenant users log in once across runs.  Only a fresh login
+    # reports the user's tenants; a choice is needed when it lists several
+    # or gives no token without one.
+    customers = []
+    try:
+        pclib.get_pc_token(name, pw, api_stack, customers=customers)
+    except (KeyError, TypeError, ValueError):
+        if not customers:
+            raise
+    if len(customers) <= 1:
+        return None
+    if not interactive:
+        raise SystemExit("User belongs to %d tenants, pass --tenant: %s" % (len(customers), ", ".join(customers)))
+    for customer_number, customer in enumerate(customers, 1):
+        print(customer_number, customer)
+    return customers[int(input("Select Tenant: ")) - 1]
+
+
+def get_resources(r_jwt, r_api_stack, rql, page_size=pclib.RQL_PAGE_SIZE):
+    # search results are paged with nextPageToken and yielded as they arrive
+    return pclib.iter_rql(r_jwt, rql, r_api_stack, page_size=page_size, time_range=SEARCH_TIME_RANGE)
+
+
+def select_rrn(d_jwt, d_api_stack, rql, page_size=pclib.RQL_PAGE_SIZE):
+    rrns = []
+    for item in get_resources(d_jwt, d_api_stack, rql, page_size):
+        rrns.append(item["rrn"])
+        print(len(rrns), item["name"])
+    if not rrns:
+        raise SystemExit("No resources match: " + rql)
+    return rrns[int(input("Select Resource: ")) - 1]
+
+
+class SnapshotCache(object):
+    # Raw snapshots never change once written, so they are kept on disk as
+    # gzipped json named by the sha256 of their content (identical configs
+    # are stored once).  A sqlite index maps rrn + timelineItemId to the
+    # digest and tracks last use; the least recently used blobs are evicted
+    # once the cache grows past max_bytes.
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'), timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs (key TEXT PRIMARY KEY, digest TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)")
+        self.db.commit()
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest + '.json.gz')
+
+    def get(self, rrn, cfg_id):
+        with self.lock:
+            row = self.db.execute("SELECT digest FROM refs WHERE key = ?", (rrn + '|' + cfg_id,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), row[0]))
+            self.db.commit()
+        try:
+            with gzip.open(self.blob_path(row[0]), 'rb') as blob:
+                return json.loads(blob.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, rrn, cfg_id, raw_json):
+        data = json.dumps(raw_json, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.' + str(threading.get_ident()) + '.tmp'
+            with gzip.open(tmp, 'wb') as blob:
+                blob.write(data)
+            os.replace(tmp, path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO refs VALUES (?, ?)", (rrn + '|' + cfg_id, digest))
+            self.db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (digest, os.path.getsize(path), time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for digest, size in self.db.execute("SELECT digest, size FROM blobs ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self.db.execute("DELETE FROM refs WHERE digest = ?", (digest,))
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
+            total -= size
+
+
+snapshot_cache = None
+diff_ignore = cfgdiff.IGNORE_PATHS
 
 
 def get_rrn_raw(r_jwt, r_api_stack, r_rrn, r_cfg_id):
-    url = r_api_stack + "/resource/raw"
-    payload = "{\"rrn\":\"" + r_rrn + "\",\"timelineItemId\":\"" + r_cfg_id + "\"}"
-    headers = {
-        'accept': "application/json; charset=UTF-8",
-        'content-type': "application/json",
-        'x-redlock-auth': r_jwt
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    return json.loads(response.text)
+    if snapshot_cache is not None:
+        cached = snapshot_cache.get(r_rrn, r_cfg_id)
+        if cached is not None:
+            return cached
+    response = post(r_api_stack, "/resource/raw", {"rrn": r_rrn, "timelineItemId": r_cfg_id}, r_jwt)
+    response.raise_for_status()
+    raw_json = response.json()
+    if snapshot_cache is not None:
+        snapshot_cache.put(r_rrn, r_cfg_id, raw_json)
+    return raw_json
 
 
-def get_rrn_diffs(t_jwt, t_api_stack, t_rrn):
-    url = t_api_stack + "/resource/timeline"
-    payload = "{\"rrn\":\"" + t_rrn + "\"}"
-    headers = {
-        'accept': "application/json; charset=UTF-8",
-        'content-type': "application/json",
-        'x-redlock-auth': t_jwt
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    timeline_json = json.loads(response.text)
-    loop = "0"
-    tl_iteration = 0
-    current_cfg_id = ""
-    previous_cfg_id = ""
-    while loop == "0":
-        if timeline_json[tl_iteration]["type"] == "state_change" \
-                and timeline_json[tl_iteration]["firstState"] is False:
-            current_cfg_id = timeline_json[tl_iteration]["id"]
-            previous_cfg_id = timeline_json[tl_iteration]["previousStateId"]
-            loop = 1
-        elif timeline_json[tl_iteration]["type"] == "state_change" \
-                and timeline_json[tl_iteration]["firstState"] is True:
-            current_cfg_id = timeline_json[tl_iteration]["id"]
-            previous_cfg_id = "NULL"
-            print "Current Config is First Config"
-            exit()
-            loop = 1
-        else:
-            tl_iteration += 1
-    current_json = get_rrn_raw(t_jwt, t_api_stack, t_rrn, current_cfg_id)
-    previous_json = get_rrn_raw(t_jwt, t_api_stack, t_rrn, previous_cfg_id)
-    return DeepDiff(previous_json, current_json)
+def get_rrn_timeline(t_jwt, t_api_stack, t_rrn):
+    response = post(t_api_stack, "/resource/timeline", {"rrn": t_rrn}, t_jwt)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_state_changes(timeline_json):
+    # Every (current, previous) config pair in the timeline, newest first.
+    # The first state has no previous config to diff against.
+    state_changes = []
+    for item in timeline_json:
+        if item["type"] == "state_change" and item["firstState"] is False:
+            state_changes.append((item["id"], item["previousStateId"], item.get("ts")))
+    return state_changes
+
+
+def get_rrn_diffs(t_jwt, t_api_stack, t_rrn, workers=8, latest_only=False):
+    timeline_json = get_rrn_timeline(t_jwt, t_api_stack, t_rrn)
+    state_changes = get_state_changes(timeline_json)
+    if latest_only:
+        state_changes = state_changes[:1]
+    if not state_changes:
+        return []
+    # each snapshot is downloaded once even when it is the "current" side
+    # of one change and the "previous" side of the next
+    cfg_ids = list(dict.fromkeys(cfg_id for change in state_changes for cfg_id in change[:2]))
+    fetch = lambda cfg_id: get_rrn_raw(t_jwt, t_api_stack, t_rrn, cfg_id)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            raw_jsons = list(pool.map(fetch, cfg_ids))
+    else:
+        raw_jsons = [fetch(cfg_id) for cfg_id in cfg_ids]
+    snapshots = dict(zip(cfg_ids, raw_jsons))
+    diffs = []
+    for current_cfg_id, previous_cfg_id, ts in state_changes:
+        diffs.append({
+            'timelineItemId': current_cfg_id,
+            'previousStateId': previous_cfg_id,
+            'ts': ts,
+            'diff': cfgdiff.diff(snapshots[previous_cfg_id], snapshots[current_cfg_id], ignore=diff_ignore)
+        })
+    return diffs
 
 
 def print_diff(local_diffs):
+    if not local_diffs:
+        print("Current Config is First Config")
     pretty_diffs = pprint.PrettyPrinter(indent=1)
-    pretty_diffs.pprint(local_diffs)
+    for change in local_diffs:
+        print("State", change['previousStateId'], "->", change['timelineItemId'])
+        for op in change['diff']:
+            pretty_diffs.pprint(op)
+
+
+def fleet_diffs(f_jwt, f_api_stack, items, workers, history):
+    # Yields (item, changes, error) in completion order, so one slow
+    # resource does not hold back the ones behind it.  items may be the
+    # search generator: resources are diffed while later pages are still
+    # being fetched, with at most workers * 4 in flight at once.  Every
+    # resource gets one timeline request and one raw request per distinct
+    # snapshot; the limiter keeps the console within --rate.
+    def diff_item(item):
+        try:
+            changes = get_rrn_diffs(f_jwt, f_api_stack, item["rrn"], workers=1, latest_only=not history)
+            return (item, changes, None)
+        except Exception as e:
+            return (item, [], e)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(diff_item, item))
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
 
 
-api_stack = get_stack()
-(name,pw)=(read_credentials())
-jwt = (get_jwt(name, pw, api_stack))
-db_rrn = get_db_rrn(jwt, api_stack)
-diffs = get_rrn_diffs(jwt, api_stack, db_rrn)
-print_diff(diffs)
-exit()
+def print_fleet_summary(results):
+    drifted = 0
+    total = 0
+    print("%-40s %-8s %s" % ("Resource", "Changes", "Changed keys"))
+    for item, changes, error in results:
+        total += 1
+        if error is not None:
+            print("%-40s %-8s %s" % (item["name"][:40], "error", error))
+            continue
+        keys = set()
+        for change in changes:
+            keys.update(cfgdiff.changed_paths(change['diff']))
+        if keys:
+            drifted += 1
+        print("%-40s %-8d %s" % (item["name"][:40], len(changes), ", ".join(sorted(keys)) or "-"))
+    print("%d of %d resources drifted" % (drifted, total))
+
+
+def write_fleet_ndjson(results, out):
+    # one line per resource: {"rrn", "name", "changes": [...], "error"}
+    for item, changes, error in results:
+        out.write(json.dumps({
+            'rrn': item["rrn"],
+            'name': item.get("name"),
+            'changes': changes,
+            'error': None if error is None else str(error)
+        }) + "\n")
+
+
+def main(argv=None):
+    global limiter, snapshot_cache, diff_ignore
+    args = parse_args(argv)
+    limiter = pclib.AdaptiveRateLimiter(rate=args.rate, max_rate=args.rate) if args.rate > 0 else None
+    diff_ignore = tuple(args.ignore) + (() if args.no_default_ignore else cfgdiff.IGNORE_PATHS)
+    if args.cache_mb > 0:
+        snapshot_cache = SnapshotCache(args.cache_dir, args.cache_mb * 1024 * 1024)
+    if not args.stack and not args.interactive:
+        raise SystemExit("--stack is required with --fleet or --rrn")
+    api_stack = args.stack or get_stack()
+    pclib.get_session(api_stack, pool_size=max(args.workers, 10))
+    (name, pw) = (read_credentials(args.user))
+    tenant = args.tenant or get_tenant(name, pw, api_stack, args.interactive)
+    jwt = lambda: pclib.get_pc_token(name, pw, api_stack, tenant)
+    if args.fleet:
+        results = fleet_diffs(jwt, api_stack, get_resources(jwt, api_stack, args.rql, args.page_size), args.workers, args.history)
+        if args.format == 'ndjson':
+            write_fleet_ndjson(results, sys.stdout)
+        else:
+            print_fleet_summary(results)
+        return 0
+    rrn = args.rrn or select_rrn(jwt, api_stack, args.rql, args.page_size)
+    diffs = get_rrn_diffs(jwt, api_stack, rrn, args.workers, latest_only=args.rrn is not None and not args.history)
+    if args.format == 'ndjson':
+        write_fleet_ndjson([({'rrn': rrn}, diffs, None)], sys.stdout)
+    else:
+        print_diff(diffs)
+    return 0
+
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,16 @@
 import pclib
+import argparse
 import configparser
 
+####################################################################
+# Command line options
+####################################################################
+parser = argparse.ArgumentParser(description='List the cloud accounts onboarded to Prisma Cloud')
+parser.add_argument('-t', '--cloud-type', default=None, help='only list accounts of this cloud type (aws, azure, gcp, ...)')
+parser.add_argument('-r', '--refresh', action='store_true', help='refresh the cached account directory before listing')
+args = parser.parse_args()
+
+
 ####################################################################
 # Read In config.ini
 ####################################################################
@@ -16,14 +26,14 @@ resourceoptions = config.options('pccresources')
 # Check for user and password from config
 # If not, then get creds
 ####################################################################
-if (user is ""): user = pclib.read_user()
-if (pw is ""): pw = pclib.read_pw()
+if (user == ""): user = pclib.read_user()
+if (pw == ""): pw = pclib.read_pw()
 
 
 ####################################################################
 # Obtain Prisma Cloud Stack
 ####################################################################
-if (api is ""):
+if (api == ""):
     apiEndpoints = config['prismacloud']['apiEndpoints']
     api = pclib.read_api(apiEndpoints)
 
@@ -31,11 +41,20 @@ if (api is ""):
 ####################################################################
 # Obtain Prisma Cloud token
 ####################################################################
-jwt = pclib.get_pc_token(user,pw,api)
+jwt = lambda: pclib.get_pc_token(user,pw,api)
 
 
 ####################################################################
-# Get Cloud Accounts
+# Get Cloud Accounts from the shared account directory
 ####################################################################
-cloudAccounts = pclib.get_cloud_accounts(jwt,api)
-#print(cloudAccounts)
\ No newline at end of file
+if args.refresh:
+    pclib.cached_cloud_accounts(jwt,api,user,refresh=True)
+directory = pclib.get_account_directory(jwt,api,user)
+if args.cloud_type:
+    cloudAccounts = directory.by_cloud_type(args.cloud_type)
+else:
+    cloudAccounts = directory.accounts()
+print("{:<14} {:<40} {}".format("Cloud", "Account ID", "Name"))
+for account in sorted(cloudAccounts, key=lambda account: (account["cloudType"] or "", account["name"])):
+    print("{:<14} {:<40} {}".format(account["cloudType"] or "-", account["id"], account["name"]))
+print("{} accounts".format(len(cloudAccounts)))
@@ -1,5 +1,29 @@
 import pclib
+import argparse
 import configparser
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+####################################################################
+# Command line options
+####################################################################
+parser = argparse.ArgumentParser(description='Pull inventory data for the [pccresources] asset types')
+parser.add_argument('-a', '--all', action='store_true', help='query every [pccresources] entry without prompting')
+parser.add_argument('-o', '--output-dir', default='.', help='directory for the per-resource csv files (--all)')
+parser.add_argument('-w', '--workers', type=int, default=4, help='resources queried at the same time (--all)')
+parser.add_argument('--console-concurrency', type=int, default=4, help='requests in flight to the console at once')
+parser.add_argument('--page-size', type=int, default=pclib.RQL_PAGE_SIZE, help='rows fetched per page')
+parser.add_argument('-s', '--sync', action='store_true', help='fetch only resources changed since the last sync and output added/changed/removed deltas')
+parser.add_argument('--full', action='store_true', help='with --sync, re-read everything and report resources that disappeared as removed')
+parser.add_argument('--store', default=None, help='snapshot store for --sync (default: ~/.prismacloud/inventory.db)')
+args = parser.parse_args()
+args.store = args.store or pclib.state_path('inventory.db')
+
 
 ####################################################################
 # Read In config.ini
@@ -31,9 +55,141 @@ if (api == ""):
 ####################################################################
 # Obtain Prisma Cloud token
 ####################################################################
+pclib.get_session(api, pool_size=max(args.workers, args.console_concurrency), max_concurrency=args.console_concurrency)
 jwt = pclib.get_pc_token(user,pw,api)
 
 
+####################################################################
+# Function: snapshot_resource
+# Streams one resource type to <output-dir>/<resource>.csv
+# Returns (resource, rows, seconds)
+####################################################################
+def snapshot_resource(resource):
+    start = time.time()
+    apiToQuery = config['pccresources'][resource]
+    path = os.path.join(args.output_dir, resource + ".csv")
+    token = lambda: pclib.get_pc_token(user,pw,api)
+    with open(path, 'w', newline='') as out:
+        rows = pclib.write_rql(token,pclib.api_name_rql(apiToQuery),api,out,page_size=args.page_size)
+    return (resource, rows, time.time() - start)
+
+
+####################################################################
+# Function: open_store
+# Snapshot store: one row per resource keyed by rrn (or id), plus the
+# time of the last sync per resource type.  Both are keyed by store_key,
+# so one store can hold several consoles and access keys
+####################################################################
+def store_key(resource):
+    return pclib.state_key(api.rstrip('/'), user) + ":" + resource
+
+
+def open_store():
+    db = sqlite3.connect(args.store, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS resources (resource TEXT, key TEXT, state TEXT, row TEXT, PRIMARY KEY (resource, key))")
+    db.execute("CREATE TABLE IF NOT EXISTS watermarks (resource TEXT PRIMARY KEY, synced_at INTEGER)")
+    return db
+
+
+####################################################################
+# Function: sync_resource
+# Asks only for resources changed since the resource type's watermark,
+# upserts them into the store and writes one json delta per line:
+# {"change": "added"|"changed"|"removed", "resource", "key", "row"}
+# Returns (resource, {added, changed, removed}, seconds)
+####################################################################
+def sync_resource(resource, out):
+    start = time.time()
+    apiToQuery = config['pccresources'][resource]
+    token = lambda: pclib.get_pc_token(user,pw,api)
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    db = open_store()
+    scope = store_key(resource)
+    now = int(start * 1000)
+    watermark = db.execute("SELECT synced_at FROM watermarks WHERE resource = ?", (scope,)).fetchone()
+    time_range = None
+    if watermark and not args.full:
+        time_range = {"type": "absolute", "value": {"startTime": watermark[0], "endTime": now}}
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+    db.execute("DELETE FROM seen")
+    db.commit()
+    def emit(change, key, row):
+        counts[change] += 1
+        out.write(json.dumps({'change': change, 'resource': resource, 'key': key, 'row': row}) + "\n")
+    for page in pclib.iter_rql_pages(token,pclib.api_name_rql(apiToQuery),api,page_size=args.page_size,time_range=time_range):
+        # take the write lock before reading, so a sync that committed
+        # meanwhile makes this one wait instead of failing with a stale
+        # read snapshot
+        db.execute("BEGIN IMMEDIATE")
+        for row in page:
+            key = row.get('rrn') or row.get('id')
+            state = row.get('stateId') or hashlib.sha256(json.dumps(row, sort_keys=True).encode()).hexdigest()
+            db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key,))
+            stored = db.execute("SELECT state FROM resources WHERE resource = ? AND key = ?", (scope, key)).fetchone()
+            if row.get('deleted'):
+                if stored:
+                    db.execute("DELETE FROM resources WHERE resource = ? AND key = ?", (scope, key))
+                    emit('removed', key, row)
+                continue
+            if stored and stored[0] == state:
+                continue
+            db.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?)", (scope, key, state, json.dumps(row)))
+            emit('changed' if stored else 'added', key, row)
+        # commit each page before the next one is fetched, so the write
+        # lock is never held across a console request and parallel
+        # resource syncs interleave
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    if time_range is None and watermark:
+        gone = db.execute("SELECT key, row FROM resources WHERE resource = ? AND key NOT IN (SELECT key FROM seen)", (scope,))
+        for key, row in gone:
+            emit('removed', key, json.loads(row))
+        db.execute("DELETE FROM resources WHERE resource = ? AND key NOT IN (SELECT key FROM seen)", (scope,))
+    db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (scope, now))
+    db.commit()
+    db.close()
+    return (resource, counts, time.time() - start)
+
+
+####################################################################
+# Function: sync_resource_file
+# sync_resource into <output-dir>/<resource>.delta.json
+####################################################################
+def sync_resource_file(resource):
+    path = os.path.join(args.output_dir, resource + ".delta.json")
+    with open(path, 'w') as out:
+        return sync_resource(resource, out)
+
+
+####################################################################
+# Snapshot (or sync) every resource type in parallel
+####################################################################
+if args.all:
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.time()
+    failed = 0
+    if args.sync:
+        print("{:<16} {:>8} {:>8} {:>8} {:>10}".format("Resource", "Added", "Changed", "Removed", "Seconds"))
+    else:
+        print("{:<16} {:>10} {:>10}".format("Resource", "Rows", "Seconds"))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        worker = sync_resource_file if args.sync else snapshot_resource
+        futures = {pool.submit(worker, resource): resource for resource in resourceoptions}
+        for future in as_completed(futures):
+            try:
+                resource, rows, seconds = future.result()
+                if args.sync:
+                    print("{:<16} {:>8} {:>8} {:>8} {:>10.1f}".format(resource, rows['added'], rows['changed'], rows['removed'], seconds))
+                else:
+                    print("{:<16} {:>10} {:>10.1f}".format(resource, rows, seconds))
+            except Exception as e:
+                failed += 1
+                print("{:<16} failed: {}".format(futures[future], e))
+    print("{:<16} {:>10} {:>10.1f}".format("Total", len(resourceoptions) - failed, time.time() - start))
+    sys.exit(1 if failed else 0)
+
+
 ####################################################################
 # Get resource to query
 ####################################################################
@@ -42,6 +198,9 @@ apiToQuery = config['pccresources'][resourceToQuery]
 
 
 ####################################################################
-# Get CSV for resource
+# Stream deltas, or the full CSV, for resource
 ####################################################################
-print(pclib.get_query_csv(jwt,apiToQuery,api))
\ No newline at end of file
+if args.sync:
+    sync_resource(resourceToQuery, sys.stdout)
+    sys.exit(0)
+pclib.write_rql(jwt,pclib.api_name_rql(apiToQuery),api,sys.stdout,page_size=args.page_size)
@@ -1,3 +1,7 @@
+# threading is imported at module level for the shared session, token
+# and directory locks; everything else is imported where it is used
+import threading
+
 
 #######################################################################
 #  Function: read_user
@@ -40,28 +44,869 @@ def read_api(apiEndpoints):
     return (api)
 
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_MAX_SLEEP = 30
+# seconds to connect, and to wait for each read, before a request fails
+# (and is retried by request_retry) instead of hanging on a dead socket
+REQUEST_TIMEOUT = (10, 300)
+
+
+#######################################################################
+#  Class: AdaptiveRateLimiter
+#  Inputs:
+#    rate - float, starting requests per second across all threads
+#    min_rate - float, floor the rate backs off to
+#    max_rate - float, ceiling the rate grows to
+#    increase - float, requests per second added per second of success
+#    cooldown - float, seconds after a cut during which further
+#               throttled() calls are ignored
+#  Returns:
+#    limiter with wait() to take a request slot, success() to grow the
+#    rate additively with time and throttled() to halve it on 429/5xx.
+#    A burst of concurrent 429s from one overloaded moment costs one
+#    halving, and the rate regains at most `increase` per second
+#######################################################################
+class AdaptiveRateLimiter:
+    def __init__(self,rate=10.0,min_rate=0.5,max_rate=100.0,increase=5.0,cooldown=1.0):
+        import time
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._next = 0.0
+        self._last_cut = -cooldown
+        self._last_increase = time.monotonic()
+
+    def wait(self):
+        import time
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self):
+        import time
+        with self._lock:
+            now = time.monotonic()
+            # growth is counted from the later of the last increase and
+            # the last cut, and an idle gap counts as at most one second
+            elapsed = min(now - max(self._last_increase, self._last_cut), 1.0)
+            self._last_increase = now
+            if now - self._last_cut >= self.cooldown and elapsed > 0:
+                self.rate = min(self.rate + self.increase * elapsed, self.max_rate)
+
+    def throttled(self):
+        import time
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_cut < self.cooldown:
+                return
+            self._last_cut = now
+            self.rate = max(self.rate / 2, self.min_rate)
+
+
+#######################################################################
+#  Class: PCSession
+#  Inputs:
+#    api - string, api url of the console this session talks to
+#    pool_size - int, keep-alive connections held open to the console
+#    keep_alive - bool, reuse connections between requests
+#    http2 - bool, speak HTTP/2 through httpx (pip install httpx[http2])
+#    verify - bool, verify the console TLS certificate
+#    max_concurrency - int, cap on requests in flight to the console
+#    timeout - (connect, read) seconds applied to every request that
+#              does not pass its own timeout=
+#  Returns:
+#    session object with request/get/post/put/patch/delete helpers that
+#    take a path relative to api, request_retry() which retries 429/5xx
+#    and connection errors with jittered backoff, plus stats() for
+#    connection reuse
+#######################################################################
+class PCSession:
+    def __init__(self,api,pool_size=10,keep_alive=True,http2=False,verify=True,max_concurrency=None,timeout=REQUEST_TIMEOUT):
+        self.api = api.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.http2 = http2
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._connections = 0
+        self._slots = None
+        self.set_max_concurrency(max_concurrency)
+        if http2:
+            import httpx
+            keep = pool_size if keep_alive else 0
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=keep)
+            self._client = httpx.Client(http2=True, verify=verify, limits=limits, timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+            # _send raises httpx transport errors as OSError
+            self._retry_errors = (OSError,)
+        else:
+            import requests
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self._client = requests.Session()
+            self._client.mount("https://", adapter)
+            self._client.mount("http://", adapter)
+            self._client.verify = verify
+            # requests connection errors and timeouts derive from IOError
+            self._retry_errors = (OSError,)
+            if not keep_alive:
+                self._client.headers["Connection"] = "close"
+
+    def url(self,path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.api + path
+
+    def set_max_concurrency(self,max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def request(self,method,path,**kwargs):
+        with self._lock:
+            self._requests += 1
+        slots = self._slots
+        if slots is None:
+            return self._send(method, path, **kwargs)
+        with slots:
+            return self._send(method, path, **kwargs)
+
+    def _send(self,method,path,**kwargs):
+        if not self.http2:
+            kwargs.setdefault("verify", self.verify)
+            kwargs.setdefault("timeout", self.timeout)
+            return self._client.request(method, self.url(path), **kwargs)
+        # httpx takes raw bodies as content=, auth on send() and has no
+        # per-request verify; requests auth objects (HTTPBasicAuth) are
+        # callables on the request, which httpx accepts as they are
+        import httpx
+        kwargs.pop("verify", None)
+        stream = kwargs.pop("stream", False)
+        auth = kwargs.pop("auth", None)
+        timeout = kwargs.pop("timeout", None)
+        if isinstance(kwargs.get("data"), (str, bytes)):
+            kwargs["content"] = kwargs.pop("data")
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout[1], connect=timeout[0]) if isinstance(timeout, tuple) else timeout
+        kwargs["extensions"] = {"trace": self._trace}
+        request = self._client.build_request(method, self.url(path), **kwargs)
+        try:
+            response = self._client.send(request, stream=stream, auth=auth)
+        except httpx.TransportError as e:
+            # callers catch OSError, which requests' errors derive from
+            raise OSError("{}: {}".format(type(e).__name__, e)) from e
+        # the requests.Response attributes the scripts rely on
+        response.ok = response.is_success
+        response.reason = response.reason_phrase
+        return response
+
+    def get(self,path,**kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self,path,**kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self,path,**kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self,path,**kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self,path,**kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def request_retry(self,method,path,retries=5,backoff=0.5,limiter=None,**kwargs):
+        import random
+        import time
+        for attempt in range(retries + 1):
+            if limiter:
+                limiter.wait()
+            try:
+                response = self.request(method, path, **kwargs)
+            except self._retry_errors:
+                if attempt == retries:
+                    raise
+                if limiter:
+                    limiter.throttled()
+                time.sleep(random.uniform(0, min(backoff * 2 ** attempt, RETRY_MAX_SLEEP)))
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                if limiter:
+                    limiter.success()
+                return response
+            if limiter:
+                limiter.throttled()
+            if attempt == retries:
+                return response
+            delay = random.uniform(0, min(backoff * 2 ** attempt, RETRY_MAX_SLEEP))
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), RETRY_MAX_SLEEP))
+            time.sleep(delay)
+
+    def _trace(self,event,info):
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self._connections += 1
+
+    def stats(self):
+        connections = self._connections
+        if not self.http2:
+            connections = 0
+            pools = self._client.get_adapter(self.api).poolmanager.pools
+            for key in pools.keys():
+                connections += pools[key].num_connections
+        return {
+            "requests": self._requests,
+            "connections": connections,
+            "reused": max(self._requests - connections, 0)
+        }
+
+    def close(self):
+        self._client.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+#######################################################################
+#  Function: get_session
+#  Inputs:
+#    api - string, api url
+#    options - PCSession keyword arguments, only used the first time
+#              a session for this api is created
+#  Returns:
+#    shared PCSession for the console
+#######################################################################
+def get_session(api,**options):
+    key = api.rstrip("/")
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = PCSession(key, **options)
+        return _sessions[key]
+
+
+#######################################################################
+#  Function: session_stats
+#  Inputs: None
+#  Returns:
+#    dict of console api url to request/connection/reuse counts
+#######################################################################
+def session_stats():
+    return {api: session.stats() for api, session in _sessions.items()}
+
+
+#######################################################################
+#  Function: print_session_stats
+#  Inputs: None
+#  Returns:
+#    None, writes one line of connection reuse counts per console to
+#    stderr so it never mixes with csv/json output on stdout
+#######################################################################
+def print_session_stats():
+    import sys
+    for api, stats in session_stats().items():
+        print("{}: {} requests over {} connections ({} reused)".format(
+            api, stats["requests"], stats["connections"], stats["reused"]), file=sys.stderr)
+
+
+TOKEN_REFRESH_MARGIN = 120
+TOKEN_DEFAULT_TTL = 600
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+#######################################################################
+#  Function: state_path
+#  Inputs:
+#    name - string, file name inside the pclib state directory
+#  Returns:
+#    path - string, ~/.prismacloud/<name> (or $PCLIB_STATE_DIR/<name>)
+#######################################################################
+def state_path(name):
+    import os
+    state_dir = os.environ.get("PCLIB_STATE_DIR", os.path.join(os.path.expanduser("~"), ".prismacloud"))
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    return os.path.join(state_dir, name)
+
+
+#######################################################################
+#  Function: file_lock
+#  Inputs:
+#    path - string, file to guard; the lock lives in <path>.lock
+#  Returns:
+#    context manager holding an exclusive lock shared between processes
+#    (posix flock; no locking where fcntl is unavailable)
+#######################################################################
+def file_lock(path):
+    import contextlib
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    @contextlib.contextmanager
+    def locked():
+        with open(path + ".lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return locked()
+
+
+#######################################################################
+#  Function: load_state / save_state
+#  Inputs:
+#    path - string, json state file
+#    data - dict, state to write atomically (owner read/write only)
+#  Returns:
+#    dict, empty when the file is missing or unreadable
+#######################################################################
+def load_state(path):
+    import json
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path,data):
+    import json
+    import os
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as state_file:
+        json.dump(data, state_file)
+    os.replace(tmp, path)
+
+
+#######################################################################
+#  Function: jwt_expiry
+#  Inputs:
+#    token - string, JWT
+#  Returns:
+#    exp - int, expiry as epoch seconds, None if it cannot be decoded
+#######################################################################
+def jwt_expiry(token):
+    import base64
+    import json
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+#######################################################################
+#  Function: state_key
+#  Inputs:
+#    parts - strings (or None), e.g. api url, access key, tenant
+#  Returns:
+#    key - string, sha256 of the parts, used to key on-disk state by
+#    console, user and tenant without storing them in clear
+#######################################################################
+def state_key(*parts):
+    import hashlib
+    return hashlib.sha256("|".join(part or "" for part in parts).encode()).hexdigest()
+
+
+#######################################################################
+#  Function: cached_token
+#  Inputs:
+#    kind - string, "pc" or "pcc"
+#    api - string, api url
+#    user - string, username / access key
+#    tenant - string, tenant (customerName) or None
+#    login - function returning a fresh token
+#    extend - function taking a token and returning an extended one
+#  Returns:
+#    token - string, taken from the in-process or on-disk cache when it
+#    still has TOKEN_REFRESH_MARGIN seconds left, extended when it is
+#    close to expiry, and only obtained through login otherwise
+#######################################################################
+def cached_token(kind,api,user,tenant,login,extend):
+    import time
+    key = state_key(kind, api.rstrip("/"), user, tenant)
+    path = state_path("tokens.json")
+    with _tokens_lock:
+        entry = _tokens.get(key)
+        if entry and entry["expires"] - time.time() > TOKEN_REFRESH_MARGIN:
+            return entry["token"]
+        with file_lock(path):
+            tokens = load_state(path)
+            entry = tokens.get(key)
+            now = time.time()
+            if not entry or entry["expires"] - now <= TOKEN_REFRESH_MARGIN:
+                token = None
+                if entry and entry["expires"] > now:
+                    try:
+                        token = extend(entry["token"])
+                    except Exception:
+                        token = None
+                if not token:
+                    token = login()
+                entry = {"token": token, "expires": jwt_expiry(token) or now + TOKEN_DEFAULT_TTL}
+                tokens = {k: v for k, v in tokens.items() if v["expires"] > now}
+                tokens[key] = entry
+                save_state(path, tokens)
+        _tokens[key] = entry
+        return entry["token"]
+
+
 #######################################################################
 #  Function: get_pc_token
 #  Inputs:
 #    user - string, username
 #    password - string, password
 #    api - string, api url
+#    tenant - string, optional tenant (customerName) to log in to
+#    customers - optional list, extended with the tenants a fresh login
+#                reports for the user (left empty on a cache hit)
 #  Returns:
-#    token - string, auth token
+#    token - string, auth token, shared through cached_token
 #######################################################################
-def get_pc_token(user,pw,api):
-    import requests
+def get_pc_token(user,pw,api,tenant=None,customers=None):
     import json
-    url = api + "/login"
-    payload = "{\"username\":\"" + user + "\",\"password\":\"" + pw + "\"}"
+    def login():
+        url = "/login"
+        payload = {"username": user, "password": pw}
+        if tenant:
+            payload["customerName"] = tenant
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "content-type": "application/json; charset=UTF-8"
+        }
+        response = get_session(api).request("POST", url, data=json.dumps(payload), headers=headers)
+        token = (response.text)
+        jtoken = json.loads(token)
+        if customers is not None:
+            customers.extend(customer["customerName"] for customer in jtoken.get("customerNames") or [])
+        return (jtoken["token"])
+    def extend(token):
+        url = "/auth_token/extend"
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "x-redlock-auth": token
+        }
+        response = get_session(api).request("GET", url, headers=headers)
+        response.raise_for_status()
+        return (response.json()["token"])
+    return cached_token("pc", api, user, tenant, login, extend)
+
+
+RQL_PAGE_SIZE = 1000
+RQL_TIME_RANGE = {"type": "relative", "value": {"unit": "hour", "amount": 24}}
+
+
+#######################################################################
+#  Function: api_name_rql
+#  Inputs:
+#    queryresource - string, api.name to query
+#  Returns:
+#    rql - string, config query for every resource of that api.name
+#######################################################################
+def api_name_rql(queryresource):
+    return ("config where api.name = '" + queryresource + "' ")
+
+
+#######################################################################
+#  Function: iter_rql_pages
+#  Inputs:
+#    jwt - string, or function returning a current token for each page
+#    rql - string
+#    api - string, api url
+#    page_size - int, rows requested per page
+#    time_range - dict, search timeRange (default: last 24 hours)
+#    with_resource_json - bool, include the resource json in each row
+#  Returns:
+#    generator of pages (lists of row dicts), following nextPageToken;
+#    the next page is only requested once the caller asks for it
+#######################################################################
+def iter_rql_pages(jwt,rql,api,page_size=RQL_PAGE_SIZE,time_range=None,with_resource_json=False):
+    import json
+    url = "/search/config"
+    payload = {
+        "query": rql,
+        "timeRange": time_range or RQL_TIME_RANGE,
+        "limit": page_size,
+        "withResourceJson": with_resource_json
+    }
+    while True:
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "content-type": "application/json; charset=UTF-8",
+            "x-redlock-auth": jwt() if callable(jwt) else jwt
+        }
+        response = get_session(api).request("POST", url, data=json.dumps(payload), headers=headers)
+        response.raise_for_status()
+        page = response.json()
+        page = page.get("data", page)
+        yield page.get("items") or []
+        if not page.get("nextPageToken"):
+            return
+        url = "/search/config/page"
+        payload = {
+            "pageToken": page["nextPageToken"],
+            "limit": page_size,
+            "withResourceJson": with_resource_json
+        }
+
+
+#######################################################################
+#  Function: iter_rql
+#  Inputs: as iter_rql_pages
+#  Returns:
+#    generator of row dicts, following nextPageToken one page at a time
+#######################################################################
+def iter_rql(jwt,rql,api,page_size=RQL_PAGE_SIZE,time_range=None,with_resource_json=False):
+    for page in iter_rql_pages(jwt, rql, api, page_size, time_range, with_resource_json):
+        yield from page
+
+
+STREAM_CHUNK_SIZE = 65536
+
+
+#######################################################################
+#  Function: iter_text_chunks
+#  Inputs:
+#    source - requests/httpx response (read with stream=True), file
+#             object, or iterable of str/bytes chunks
+#    chunk_size - int, bytes read from the socket at a time
+#  Returns:
+#    generator of str chunks, utf-8 decoded incrementally so multi-byte
+#    characters split across chunks survive
+#######################################################################
+def iter_text_chunks(source,chunk_size=STREAM_CHUNK_SIZE):
+    import codecs
+    if hasattr(source, "iter_content"):
+        chunks = source.iter_content(chunk_size)
+    elif hasattr(source, "iter_bytes"):
+        chunks = source.iter_bytes(chunk_size)
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
+    else:
+        chunks = source
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+    yield decoder.decode(b"", final=True)
+
+
+#######################################################################
+#  Function: iter_json_array
+#  Inputs:
+#    source - anything iter_text_chunks reads: a streamed response of a
+#             json list endpoint (e.g. /api/v1/collections), a file or
+#             an iterable of chunks
+#    chunk_size - int, bytes read from the socket at a time
+#  Returns:
+#    generator of the array elements, decoded one at a time as the
+#    chunks arrive; a null body yields nothing.  Only the unparsed tail
+#    of the current chunk is kept, whatever the payload size
+#######################################################################
+def iter_json_array(source,chunk_size=STREAM_CHUNK_SIZE):
+    import json
+    import re
+    decode = json.JSONDecoder().raw_decode
+    skip = re.compile(r"[\s,]*").match
+    chunks = iter_text_chunks(source, chunk_size)
+    buf = ""
+    pos = 0
+    done = False
+    def more():
+        # drop what was parsed and append the next chunk; False at the end
+        nonlocal buf, pos, done
+        for chunk in chunks:
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                return True
+        done = True
+        return False
+    try:
+        while True:
+            pos = skip(buf, pos).end()
+            if pos < len(buf) or not more():
+                break
+        if buf[pos:pos + 1] != "[":
+            while more():
+                pass
+            if buf[pos:].strip() in ("", "null"):
+                return
+            raise ValueError("expected a json array, got: " + buf[pos:pos + 40])
+        pos += 1
+        while True:
+            pos = skip(buf, pos).end()
+            if pos >= len(buf):
+                if not more():
+                    raise ValueError("json array is not terminated")
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decode(buf, pos)
+            except ValueError:
+                # element continues in the next chunks; read until the
+                # unparsed tail doubles so a large element is not
+                # re-decoded once per chunk
+                want = 2 * (len(buf) - pos)
+                if not more():
+                    raise
+                while len(buf) - pos < want and more():
+                    pass
+                continue
+            if isinstance(item, (int, float)) and not isinstance(item, bool):
+                # raw_decode stops a number at a chunk boundary ("1." of
+                # "1.5e10"), so only take it once a delimiter follows
+                if (end == len(buf) or buf[end] not in ",] \t\r\n") and not done and more():
+                    continue
+            elif end == len(buf) and not done and more():
+                # a literal may continue in the next chunk
+                continue
+            pos = end
+            yield item
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+
+#######################################################################
+#  Function: iter_text_lines
+#  Inputs:
+#    source - anything iter_text_chunks reads
+#    chunk_size - int, bytes read from the socket at a time
+#  Returns:
+#    generator of lines with their line endings, as csv.reader expects
+#######################################################################
+def iter_text_lines(source,chunk_size=STREAM_CHUNK_SIZE):
+    tail = ""
+    for chunk in iter_text_chunks(source, chunk_size):
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if tail:
+        yield tail
+
+
+#######################################################################
+#  Function: rql_column
+#  Inputs:
+#    item - dict, search result row
+#    column - string, row field or dotted path, looked up in the row
+#             first and then in its resource json ("data")
+#  Returns:
+#    value, None when missing
+#######################################################################
+def rql_column(item,column):
+    value = get_path(item, column)
+    if value is None and isinstance(item.get("data"), dict):
+        value = get_path(item["data"], column)
+    return value
+
+
+#######################################################################
+#  Function: iter_rql_rows
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    rql - string, may addcolumn the fields to read
+#    api - string, api url
+#    columns - list of strings, columns to keep, e.g.
+#              ["name", "properties.loginServer"]
+#    fmt - "csv" to stream the text/csv export, "json" to page through
+#          json results with the resource json included
+#    page_size - int, rows requested per json page
+#    time_range - dict, search timeRange (default: last 24 hours)
+#  Returns:
+#    generator of {column: value} dicts holding only the requested
+#    columns.  csv is parsed row by row as it arrives (quoted commas
+#    and newlines included), json one page at a time, so memory stays
+#    flat however many rows match.  A non-empty csv export with no
+#    header row naming every requested column raises ValueError
+#######################################################################
+def iter_rql_rows(jwt,rql,api,columns,fmt="csv",page_size=RQL_PAGE_SIZE,time_range=None):
+    import csv
+    import json
+    if fmt == "json":
+        for item in iter_rql(jwt, rql, api, page_size=page_size, time_range=time_range, with_resource_json=True):
+            yield {column: rql_column(item, column) for column in columns}
+        return
+    payload = {
+        "query": rql,
+        "timeRange": time_range or RQL_TIME_RANGE,
+        "withResourceJson": True
+    }
     headers = {
-        "accept": "application/json; charset=UTF-8",
-        "content-type": "application/json; charset=UTF-8"
+        "accept": "text/csv; charset=UTF-8",
+        "content-type": "application/json; charset=UTF-8",
+        "x-redlock-auth": jwt() if callable(jwt) else jwt
     }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    token = (response.text)
-    jtoken = json.loads(token)
-    return (jtoken["token"])
+    response = get_session(api).request("POST", "/search/config", data=json.dumps(payload), headers=headers, stream=True)
+    response.raise_for_status()
+    try:
+        reader = csv.reader(iter_text_lines(response))
+        # the header is the first row naming every requested column; the
+        # export may put other lines before it
+        wanted = [column.lower() for column in columns]
+        seen = []
+        for row in reader:
+            header = {cell.strip().lower(): index for index, cell in enumerate(row)}
+            if all(column in header for column in wanted):
+                indexes = [header[column] for column in wanted]
+                break
+            seen.append(row)
+        else:
+            if not seen:
+                return
+            # report the missing columns against the closest candidate
+            best = max(seen, key=lambda row: len(set(wanted) & set(cell.strip().lower() for cell in row)))
+            cells = set(cell.strip().lower() for cell in best)
+            missing = [column for column, name in zip(columns, wanted) if name not in cells]
+            raise ValueError("RQL csv export has no header row with column(s) {}; rows seen: {}".format(
+                ", ".join(missing), "; ".join(",".join(row) for row in seen[:5])))
+        for row in reader:
+            if row:
+                yield {column: row[index] if index < len(row) else None for column, index in zip(columns, indexes)}
+    finally:
+        response.close()
+
+
+#######################################################################
+#  Function: get_path
+#  Inputs:
+#    row - dict
+#    path - string, key or dotted path into nested dicts ("a.b.c")
+#  Returns:
+#    value at path, None when any part is missing
+#######################################################################
+def get_path(row,path):
+    if path in row:
+        return row[path]
+    value = row
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+#######################################################################
+#  Function: iter_rql_csv
+#  Inputs:
+#    rows - iterable of row dicts (e.g. from iter_rql)
+#    columns - list of column names or dotted paths (default: keys of
+#              the first row)
+#  Returns:
+#    generator of csv lines, header first; nested values as json
+#######################################################################
+def iter_rql_csv(rows,columns=None):
+    import csv
+    import io
+    import json
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    def line(values):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(values)
+        return buf.getvalue()
+    header = False
+    for row in rows:
+        if not header:
+            columns = columns or list(row.keys())
+            header = True
+            yield line(columns)
+        values = []
+        for column in columns:
+            value = get_path(row, column)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            values.append(value)
+        yield line(values)
+
+
+#######################################################################
+#  Function: write_rows
+#  Inputs:
+#    rows - iterable of row dicts
+#    out - file object for "csv"/"json", file path for "parquet"
+#    fmt - string, "csv", "json" (one json object per line, also
+#          accepted as "ndjson") or "parquet" (needs pyarrow)
+#    columns - list of column names or dotted paths for csv/parquet
+#    batch_size - int, rows buffered per parquet row group
+#  Returns:
+#    count - int, rows written; only one batch is held in memory
+#######################################################################
+def write_rows(rows,out,fmt="json",columns=None,batch_size=1000):
+    import json
+    count = 0
+    if fmt == "csv":
+        for line in iter_rql_csv(rows, columns):
+            out.write(line)
+            count += 1
+        return max(count - 1, 0)
+    if fmt == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        batch = []
+        def flush(writer):
+            if writer is None:
+                table = pyarrow.Table.from_pylist(batch)
+                # columns that were empty in the first batch default to strings
+                schema = pyarrow.schema([field.with_type(pyarrow.string()) if pyarrow.types.is_null(field.type) else field for field in table.schema])
+                writer = pyarrow.parquet.ParquetWriter(out, schema)
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=writer.schema))
+            return writer
+        for row in rows:
+            columns = columns or list(row.keys())
+            values = {}
+            for column in columns:
+                value = get_path(row, column)
+                values[column] = json.dumps(value) if isinstance(value, (dict, list)) else value
+            batch.append(values)
+            count += 1
+            if len(batch) >= batch_size:
+                writer = flush(writer)
+                batch = []
+        if batch:
+            writer = flush(writer)
+        if writer:
+            writer.close()
+        return count
+    for row in rows:
+        out.write(json.dumps(row) + "\n")
+        count += 1
+    return count
+
+
+#######################################################################
+#  Function: write_rql
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    rql - string
+#    api - string, api url
+#    out - file object to write to (e.g. sys.stdout)
+#    fmt - string, "csv" or "json" (one json object per line)
+#    page_size - int, rows requested per page
+#    time_range - dict, search timeRange (default: last 24 hours)
+#  Returns:
+#    count - int, rows written; memory stays bounded to one page
+#######################################################################
+def write_rql(jwt,rql,api,out,fmt="csv",page_size=RQL_PAGE_SIZE,time_range=None):
+    rows = iter_rql(jwt, rql, api, page_size=page_size, time_range=time_range)
+    return (write_rows(rows, out, fmt))
 
 
 #######################################################################
@@ -74,16 +919,7 @@ def get_pc_token(user,pw,api):
 #    csv file
 #######################################################################
 def get_query_csv(jwt,queryresource,api):
-    import requests
-    url = api + "/search/config"
-    payload = "{\"query\":\"config where api.name = '" + queryresource + "' \",\"timeRange\":{\"type\":\"relative\",\"value\":{\"unit\":\"hour\",\"amount\":24}}}"
-    headers = {
-        "accept": "text/csv; charset=UTF-8",
-        "content-type": "application/json; charset=UTF-8",
-        "x-redlock-auth": jwt
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    return(response.text)
+    return(get_rql_csv(jwt,api_name_rql(queryresource),api))
 
 
 #######################################################################
@@ -92,19 +928,11 @@ def get_query_csv(jwt,queryresource,api):
 #    jwt - string
 #    rql - string
 #  Returns:
-#    csv file
+#    csv file, every page joined into one string; use write_rql to
+#    stream large results instead
 #######################################################################
 def get_rql_csv(jwt,rql,api):
-    import requests
-    url = api + "/search/config"
-    payload = "{\"query\":\"" + rql + "\",\"timeRange\":{\"type\":\"relative\",\"value\":{\"unit\":\"hour\",\"amount\":24}}}"
-    headers = {
-        "accept": "text/csv; charset=UTF-8",
-        "content-type": "application/json; charset=UTF-8",
-        "x-redlock-auth": jwt
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    return(response.text)
+    return("".join(iter_rql_csv(iter_rql(jwt,rql,api))))
 
 
 
@@ -115,21 +943,31 @@ def get_rql_csv(jwt,rql,api):
 #    password - string, password
 #    api - string, api url
 #  Returns:
-#    token - string, auth token
+#    token - string, auth token, shared through cached_token
 #######################################################################
 def get_pcc_token(user,password,api):
-    import requests
     import json
-    url = api + "/api/v1/authenticate"
-    payload = "{\"username\":\"" + user + "\",\"password\":\"" + password + "\"}"
-    headers = {
-        "accept": "application/json; charset=UTF-8",
-        "content-type": "application/json; charset=UTF-8"
-    }
-    response = requests.request("POST", url, data=payload, headers=headers)
-    token = (response.text)
-    jtoken = json.loads(token)
-    return (jtoken["token"])
+    def login():
+        url = "/api/v1/authenticate"
+        payload = {"username": user, "password": password}
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "content-type": "application/json; charset=UTF-8"
+        }
+        response = get_session(api).request("POST", url, data=json.dumps(payload), headers=headers)
+        token = (response.text)
+        jtoken = json.loads(token)
+        return (jtoken["token"])
+    def extend(token):
+        url = "/api/v1/authenticate/renew"
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "Authorization": "Bearer " + token
+        }
+        response = get_session(api).request("GET", url, headers=headers)
+        response.raise_for_status()
+        return (response.json()["token"])
+    return cached_token("pcc", api, user, None, login, extend)
 
 
 
@@ -163,23 +1001,306 @@ def get_resource_to_query(resourceoptions):
     return(resourceToQuery)
 
 
+CLOUD_ACCOUNTS_TTL = 3600
+# oldest directory a background-refreshing AccountDirectory still answers from
+CLOUD_ACCOUNTS_MAX_AGE = 86400
+CLOUD_TYPES = ("aws", "azure", "gcp")
+# accounts whose children (member accounts, subscriptions, projects) are
+# listed through /cloud/<cloudType>/<accountId>/project
+CLOUD_PARENT_TYPES = ("organization", "tenant", "masterServiceAccount")
+
+
+#######################################################################
+#  Function: iter_cloud_children
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    cloud_type - string, "aws", "azure" or "gcp"
+#    parent_id - string, organization/tenant/master account id
+#  Returns:
+#    generator of child account dicts; paged responses
+#    ({"items": [...], "nextPageToken": ...}) are followed page by page
+#######################################################################
+def iter_cloud_children(jwt,api,cloud_type,parent_id):
+    url = "/cloud/" + cloud_type + "/" + parent_id + "/project"
+    params = {"excludeAccountGroupDetails": "true"}
+    while True:
+        headers = {
+            "accept": "application/json; charset=UTF-8",
+            "x-redlock-auth": jwt() if callable(jwt) else jwt
+        }
+        response = get_session(api).request_retry("GET", url, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json()
+        if isinstance(page, list):
+            yield from page
+            return
+        yield from page.get("items") or []
+        if not page.get("nextPageToken"):
+            return
+        params = dict(params, pageToken=page["nextPageToken"])
+
+
+#######################################################################
+#  Function: discover_cloud_accounts
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    cloud_types - list of cloud types to include (default: all)
+#    workers - int, parent accounts crawled at the same time
+#  Returns:
+#    {cloudType: {accountId: name}} for every onboarded account, with
+#    aws/azure/gcp organization/tenant/master accounts replaced by their
+#    children (member accounts, subscriptions, projects), fetched
+#    concurrently
+#######################################################################
+def discover_cloud_accounts(jwt,api,cloud_types=None,workers=8):
+    from concurrent.futures import ThreadPoolExecutor
+    headers = {
+        "accept": "application/json; charset=UTF-8",
+        "x-redlock-auth": jwt() if callable(jwt) else jwt
+    }
+    response = get_session(api).request_retry("GET", "/cloud", headers=headers)
+    response.raise_for_status()
+    accounts = {cloud_type: {} for cloud_type in cloud_types or CLOUD_TYPES}
+    parents = []
+    for account in response.json():
+        account = account.get("cloudAccount", account)
+        cloud_type = account.get("cloudType")
+        if cloud_types and cloud_type not in cloud_types:
+            continue
+        if cloud_type in CLOUD_TYPES and account.get("accountType") in CLOUD_PARENT_TYPES:
+            parents.append((cloud_type, account["accountId"]))
+        else:
+            accounts.setdefault(cloud_type, {})[account["accountId"]] = account["name"]
+    crawl = lambda parent: (parent[0], list(iter_cloud_children(jwt, api, parent[0], parent[1])))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for cloud_type, children in pool.map(crawl, parents):
+            for child in children:
+                accounts[cloud_type].setdefault(child["accountId"], child["name"])
+    return accounts
+
+
+#######################################################################
+#  Function: load_cloud_accounts
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    user - string, username / access key the token belongs to
+#    tenant - string, tenant (customerName) or None
+#    ttl - int, seconds a crawl is reused for
+#    newer_than - epoch seconds, also crawl again unless the cached
+#                 crawl is newer than this (None: only the ttl counts)
+#    workers - int, parent accounts crawled at the same time
+#  Returns:
+#    {"fetchedAt": epoch seconds, "accounts": {cloudType: {accountId:
+#    name}}} as from discover_cloud_accounts, shared between runs
+#    through ~/.prismacloud/cloud_accounts.json; the file is locked so
+#    parallel jobs crawl the hierarchy once.  Entries are keyed like
+#    cached_token by console, user and tenant, since one stack serves
+#    many tenants
+#######################################################################
+def load_cloud_accounts(jwt,api,user,tenant=None,ttl=CLOUD_ACCOUNTS_TTL,newer_than=None,workers=8):
+    import time
+    key = state_key(api.rstrip("/"), user, tenant)
+    path = state_path("cloud_accounts.json")
+    with file_lock(path):
+        entry = load_state(path).get(key)
+        if entry and time.time() - entry["fetchedAt"] < ttl and (newer_than is None or entry["fetchedAt"] > newer_than):
+            return entry
+        entry = {"fetchedAt": time.time(), "accounts": discover_cloud_accounts(jwt, api, workers=workers)}
+        state = load_state(path)
+        state[key] = entry
+        save_state(path, state)
+    return entry
+
+
+#######################################################################
+#  Function: cached_cloud_accounts
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    user - string, username / access key the token belongs to
+#    tenant - string, tenant (customerName) or None
+#    ttl - int, seconds a crawl is reused for
+#    refresh - bool, crawl again even when the cache is fresh
+#    workers - int, parent accounts crawled at the same time
+#  Returns:
+#    {cloudType: {accountId: name}} from load_cloud_accounts
+#######################################################################
+def cached_cloud_accounts(jwt,api,user,tenant=None,ttl=CLOUD_ACCOUNTS_TTL,refresh=False,workers=8):
+    import time
+    newer_than = time.time() if refresh else None
+    return load_cloud_accounts(jwt, api, user, tenant, ttl, newer_than, workers)["accounts"]
+
+
 #######################################################################
 #  Function: get_cloud_accounts
-#  Inputs: jwt authentication token
+#  Inputs: jwt authentication token (or function returning one)
 #          api endoint to connect to
+#          cloud_type - optional "aws", "azure", "gcp", ... filter
 #  Returns:
-#    accounts
+#    accounts - list of {"id", "name", "cloudType"} dicts
 #######################################################################
-def get_cloud_accounts(jwt,api):
-    import requests
-    import json
-    url = api + "/cloud/name"
+def get_cloud_accounts(jwt,api,cloud_type=None):
+    url = "/cloud/name"
     headers = {
         "accept": "application/json; charset=UTF-8",
-        "x-redlock-auth": jwt
+        "x-redlock-auth": jwt() if callable(jwt) else jwt
     }
-    response = requests.request("GET", url, headers=headers)
-    print (response.text)
-    cloudAccounts = json.loads(response.text)
-    print (cloudAccounts["name"])
-    return (response.json())
\ No newline at end of file
+    params = {"cloudType": cloud_type} if cloud_type else None
+    response = get_session(api).request_retry("GET", url, headers=headers, params=params)
+    response.raise_for_status()
+    return (response.json())
+
+
+#######################################################################
+#  Class: AccountDirectory
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    user - string, username / access key the token belongs to
+#    tenant - string, tenant (customerName) or None
+#    ttl - int, seconds before the directory is refreshed
+#    background - bool, refresh in a background thread and keep
+#                 answering from the current indexes meanwhile; only
+#                 for long-lived processes, a short CLI run would exit
+#                 before the refresh lands
+#    max_age - int, seconds past which even a background directory
+#              refreshes before answering
+#  Returns:
+#    directory of the console's cloud accounts with dict lookups by id
+#    (get/name), by name (find) and by cloud type (by_cloud_type),
+#    indexed from the load_cloud_accounts cache
+#    (~/.prismacloud/cloud_accounts.json) shared by every process.
+#    Once older than ttl a lookup refreshes it first; a refresh patches
+#    the indexes with only the accounts that were added, renamed or
+#    removed
+#######################################################################
+class AccountDirectory:
+    def __init__(self,jwt,api,user,tenant=None,ttl=CLOUD_ACCOUNTS_TTL,background=False,max_age=CLOUD_ACCOUNTS_MAX_AGE):
+        self.jwt = jwt
+        self.api = api.rstrip("/")
+        self.user = user
+        self.tenant = tenant
+        self.ttl = ttl
+        self.background = background
+        self.max_age = max_age
+        self.fetched_at = 0
+        self._by_id = {}
+        self._by_name = {}
+        self._by_cloud_type = {}
+        self._lock = threading.Lock()
+        self._refreshing = None
+        # a background directory starts from whatever is cached, however old
+        self._update(ttl=float("inf") if background else ttl)
+
+    def _apply(self,accounts,fetched_at):
+        # accounts: list of [id, name, cloudType]; index only the changes
+        with self._lock:
+            current = {account[0]: account for account in accounts}
+            for account_id in [account_id for account_id in self._by_id if account_id not in current]:
+                self._remove(self._by_id.pop(account_id))
+            for account_id, account in current.items():
+                record = {"id": account[0], "name": account[1], "cloudType": account[2]}
+                old = self._by_id.get(account_id)
+                if old == record:
+                    continue
+                if old:
+                    self._remove(old)
+                self._by_id[account_id] = record
+                self._by_name.setdefault(record["name"], {})[account_id] = record
+                self._by_cloud_type.setdefault(record["cloudType"], {})[account_id] = record
+            self.fetched_at = fetched_at
+
+    def _remove(self,record):
+        for index, key in ((self._by_name, record["name"]), (self._by_cloud_type, record["cloudType"])):
+            index.get(key, {}).pop(record["id"], None)
+            if not index.get(key, True):
+                del index[key]
+
+    def _update(self,newer_than=None,ttl=None):
+        entry = load_cloud_accounts(self.jwt, self.api, self.user, self.tenant, self.ttl if ttl is None else ttl, newer_than)
+        accounts = [[account_id, name, cloud_type] for cloud_type, names in entry["accounts"].items() for account_id, name in names.items()]
+        self._apply(accounts, entry["fetchedAt"])
+
+    def refresh(self):
+        # crawl again unless another process already did since this loaded
+        self._update(newer_than=self.fetched_at)
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing and self._refreshing.is_alive():
+                return self._refreshing
+            self._refreshing = threading.Thread(target=self._refresh_quietly, daemon=True)
+            self._refreshing.start()
+            return self._refreshing
+
+    def _refresh_quietly(self):
+        import sys
+        try:
+            self._update()
+        except Exception as e:
+            print("account directory refresh failed: {}".format(e), file=sys.stderr)
+
+    def _check(self):
+        import time
+        age = time.time() - self.fetched_at
+        if age < self.ttl:
+            return
+        if self.background and age < self.max_age:
+            self.refresh_in_background()
+        else:
+            self._update()
+
+    def get(self,account_id):
+        self._check()
+        return self._by_id.get(account_id)
+
+    def name(self,account_id,default=None):
+        record = self.get(account_id)
+        return record["name"] if record else default
+
+    def find(self,name):
+        self._check()
+        with self._lock:
+            return list(self._by_name.get(name, {}).values())
+
+    def by_cloud_type(self,cloud_type):
+        self._check()
+        with self._lock:
+            return list(self._by_cloud_type.get(cloud_type, {}).values())
+
+    def accounts(self):
+        self._check()
+        with self._lock:
+            return list(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+#######################################################################
+#  Function: get_account_directory
+#  Inputs:
+#    jwt - string, or function returning a current token
+#    api - string, api url
+#    user - string, username / access key the token belongs to
+#    tenant - string, tenant (customerName) or None
+#    ttl - int, seconds before the directory is refreshed
+#    background - bool, refresh in a background thread (long-lived
+#                 processes only, see AccountDirectory)
+#  Returns:
+#    shared AccountDirectory for the console, user and tenant; the
+#    first call's options win
+#######################################################################
+def get_account_directory(jwt,api,user,tenant=None,ttl=CLOUD_ACCOUNTS_TTL,background=False):
+    key = state_key(api.rstrip("/"), user, tenant)
+    with _directories_lock:
+        if key not in _directories:
+            _directories[key] = AccountDirectory(jwt, api, user, tenant, ttl, background)
+        return _directories[key]
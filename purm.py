@@ -9,6 +9,7 @@ import argparse
 import requests
 from requests.auth import HTTPBasicAuth
 import urllib3
+import pclib
 import urllib.parse
 urllib3.disable_warnings()
 
@@ -65,11 +66,8 @@ def printDebug(message):
 
 def getToken(console,user,password):
     printDebug("Getting bearer token.")
-    api = console + '/login'
-    data = {'username': user, 'password': password}
-    response = requests.post(api, json=data, verify=False)
-    printDebug(response)
-    token = response.json()['token']
+    pclib.get_session(console, verify=False)
+    token = pclib.get_pc_token(user,password,console)
     bearer = "Bearer " + token
     headers = {'content-type':'application/json', 'Authorization': bearer}
     return(headers)
@@ -9,6 +9,7 @@ import requests
 from requests.auth import HTTPBasicAuth
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import pclib
 
 
 
@@ -65,20 +66,18 @@ def parse_args():
     return args
 
 def get_collections_json(console,user,password):
+    # generator of collection dicts, parsed as the response streams in
     api_endpt = '/api/v1/collections'
-    request_url = console + api_endpt
-    collection_req = requests.get(request_url, verify=False, auth=HTTPBasicAuth(user,password))
-    return collection_req.text
+    collection_req = pclib.get_session(console, verify=False).get(api_endpt, auth=HTTPBasicAuth(user,password), stream=True)
+    return pclib.iter_json_array(collection_req)
 
 def create_new_collection(console,user,password,collection_meta):
     print("Create new collection and add namespace")
     api_endpt = '/api/v1/collections'
-    request_url = console + api_endpt
-    print(request_url)
-    collection_req = requests.post(request_url, headers={"Authorization": "Bearer " + console_token}, data=json.dumps(collection_meta), verify=False)
-    collection_req = requests.post(
-        request_url,
-        verify=False,
+    session = pclib.get_session(console, verify=False)
+    print(session.url(api_endpt))
+    collection_req = session.post(
+        api_endpt,
         data=json.dumps(collection_meta),
         headers={"Content-Type": "application/json"},
         auth=HTTPBasicAuth(user,password)
@@ -88,16 +87,14 @@ def create_new_collection(console,user,password,collection_meta):
         raise colRequestError('GET /api/v1/collections {} {}'.format(collection_req.status_code,collection_req.reason))
     return collection_req.text
 
-def check_collection_for_ns(ns,col,collections_str):
-    for row in (collections_str.split("\n")):
-        if (row):
-            collection_dict = json.loads(row[1:])
-            if (collection_dict['name'] == col):
-                if ns not in collection_dict['namespaces']:
-                    collection_dict['namespaces'].append(ns)
-                    return (101, collection_dict)
-                else:
-                    return (102, collection_dict)
+def check_collection_for_ns(ns,col,collections):
+    for collection_dict in collections:
+        if (collection_dict['name'] == col):
+            if ns not in collection_dict['namespaces']:
+                collection_dict['namespaces'].append(ns)
+                return (101, collection_dict)
+            else:
+                return (102, collection_dict)
     collection_dict = {
         "namespaces": ns,
         "name": col
@@ -115,7 +112,7 @@ def main():
         print("Error querying API: {}".format(e))
         return 3
 
-    col_status, collection_update_dict = check_collection_for_ns(args.namespace,args.collection,collections_json[:-1])
+    col_status, collection_update_dict = check_collection_for_ns(args.namespace,args.collection,collections_json)
     if col_status == 100:
         col_put = create_new_collection(args.console,args.user,args.password,collection_update_dict)
     elif col_status == 101:
@@ -0,0 +1,20 @@
+import json
+import pclib
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_iter_json_array_numbers_split_across_chunks():
+    doc = '[1.5e10, -2.25E-3, 10, 3.0, true, null, "x", {"a": [1.5, 2e+2]}, 12345678901234567890, -0.5]'
+    expected = json.loads(doc)
+    for size in range(1, 8):
+        items = list(pclib.iter_json_array(chunked(doc, size)))
+        assert items == expected
+        assert [type(item) for item in items] == [type(item) for item in expected]
+
+
+def test_iter_json_array_float_alone_in_one_byte_chunks():
+    assert list(pclib.iter_json_array(chunked("[1.5e10]", 1))) == [1.5e10]
+    assert list(pclib.iter_json_array(chunked("[1.5e10]", 3))) == [1.5e10]